@@ -0,0 +1,79 @@
+"""Free slot computation and slot keys for appointment conflict detection.
+
+Busy time (booked appointments and blocked periods) is merged into a sorted
+list of disjoint intervals once per request, and candidate slots are then
+checked against it with a single forward sweep, so computing a month of
+availability costs O(appointments + slots) without a query per slot.
+"""
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, List, Tuple
+
+Interval = Tuple[datetime, datetime]
+
+# Granularity of slot keys. Appointment times are expected on the quarter hour;
+# two appointments that touch inside the same quarter hour are treated as overlapping.
+SLOT_KEY_MINUTES = 15
+
+
+def merge_intervals(intervals: Iterable[Interval]) -> List[Interval]:
+    """Sort intervals and merge the ones that overlap or touch"""
+    merged: List[Interval] = []
+    for start, end in sorted(intervals):
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def free_slots(
+    range_start: datetime,
+    range_end: datetime,
+    working_hours: Dict[int, List[Tuple[time, time]]],
+    slot_minutes: int,
+    busy: Iterable[Interval],
+) -> List[Interval]:
+    """Slots of slot_minutes inside working hours and [range_start, range_end) that avoid busy time.
+
+    working_hours maps a weekday (0 = Monday) to its (opening, closing) periods.
+    """
+    slot_length = timedelta(minutes=slot_minutes)
+    busy_intervals = merge_intervals(busy)
+    slots: List[Interval] = []
+    index = 0
+
+    day: date = range_start.date()
+    while day <= range_end.date():
+        for opening, closing in sorted(working_hours.get(day.weekday(), [])):
+            slot_start = max(datetime.combine(day, opening), range_start)
+            period_end = min(datetime.combine(day, closing), range_end)
+            while slot_start + slot_length <= period_end:
+                slot_end = slot_start + slot_length
+                # Busy intervals that end before this slot can never overlap a later one
+                while index < len(busy_intervals) and busy_intervals[index][1] <= slot_start:
+                    index += 1
+                if index < len(busy_intervals) and busy_intervals[index][0] < slot_end:
+                    # Jump to the end of the busy interval, keeping slots on the grid
+                    blocked_until = busy_intervals[index][1]
+                    steps = -(-(blocked_until - slot_start) // slot_length)
+                    slot_start += steps * slot_length
+                    continue
+                slots.append((slot_start, slot_end))
+                slot_start = slot_end
+        day += timedelta(days=1)
+
+    return slots
+
+
+def slot_keys(starts_at: datetime, duration_minutes: int) -> List[str]:
+    """Keys of every quarter hour an appointment occupies, for the unique slot index"""
+    ends_at = starts_at + timedelta(minutes=duration_minutes)
+    cell = starts_at.replace(minute=starts_at.minute - starts_at.minute % SLOT_KEY_MINUTES, second=0, microsecond=0)
+    keys = []
+    while cell < ends_at:
+        keys.append(cell.strftime("%Y-%m-%dT%H:%M"))
+        cell += timedelta(minutes=SLOT_KEY_MINUTES)
+    return keys
@@ -0,0 +1,117 @@
+"""Microbenchmark of the /api/patients response path for one 1000-row page.
+
+Compares the previous path (build Patient models, let FastAPI validate them
+again through response_model and encode them with the stdlib JSON encoder)
+with model_list_response (one validation pass, orjson). MongoDB is not
+involved: both routes serve the same in-memory documents, so the numbers
+isolate validation and serialization.
+
+Usage: python benchmark_serialization.py [--rows 1000] [--requests 200]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+from server import Patient, model_list_response
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def synthetic_patients(rows: int) -> List[dict]:
+    created_at = datetime(2024, 1, 1, 8, 0)
+    return [
+        {
+            "_id": uuid.uuid4().hex[:24],
+            "id": str(uuid.uuid4()),
+            "name": f"Paciente {index:05d} da Silva",
+            "address": f"Rua das Flores, {index}",
+            "neighborhood": "Centro",
+            "city": "São Paulo",
+            "state": "SP",
+            "cep": "01001-000",
+            "birth_date": "1980-05-17",
+            "sex": "F" if index % 2 else "M",
+            "profession": "Professora",
+            "contact": f"(11) 9{index:04d}-{index:04d}",
+            "cpf": "",
+            "search_name": f"paciente {index:05d} da silva",
+            "search_phone": f"119{index:04d}{index:04d}",
+            "created_at": created_at + timedelta(minutes=index),
+            "updated_at": created_at + timedelta(minutes=index),
+        }
+        for index in range(rows)
+    ]
+
+
+def build_app(documents: List[dict]) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/before", response_model=List[Patient], response_class=JSONResponse)
+    async def before():
+        return [Patient(**patient) for patient in documents]
+
+    @app.get("/after", response_model=List[Patient])
+    async def after():
+        return model_list_response(Patient, documents)
+
+    return app
+
+
+async def measure(client: httpx.AsyncClient, path: str, requests: int) -> dict:
+    # Warm up caches (TypeAdapter, route compilation) before timing
+    for _ in range(5):
+        (await client.get(path)).raise_for_status()
+
+    latencies = []
+    size = 0
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = await client.get(path)
+        latencies.append((time.perf_counter() - started) * 1000)
+        size = len(response.content)
+    latencies.sort()
+    return {
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "bytes": size,
+    }
+
+
+async def main(rows: int, requests: int) -> dict:
+    documents = synthetic_patients(rows)
+    app = build_app(documents)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        before, after = (await client.get("/before")).json(), (await client.get("/after")).json()
+        assert before == after, "Both paths must produce the same payload"
+        results = {
+            "rows": rows,
+            "requests": requests,
+            "before": await measure(client, "/before", requests),
+            "after": await measure(client, "/after", requests),
+        }
+    results["speedup_p50"] = round(results["before"]["p50_ms"] / results["after"]["p50_ms"], 2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(main(args.rows, args.requests)), indent=2))
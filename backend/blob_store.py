@@ -0,0 +1,143 @@
+"""Binary blob storage for signature images.
+
+Blobs are content addressed: the id of a blob is the SHA-256 of its bytes, so
+the same image is stored once and the id doubles as a strong ETag.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import Tuple
+
+from gridfs.errors import FileExists, NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo.errors import DuplicateKeyError
+
+BLOB_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+def blob_id_for(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore:
+    """Interface implemented by every blob storage backend"""
+
+    async def put(self, data: bytes, content_type: str) -> str:
+        raise NotImplementedError
+
+    async def get(self, blob_id: str) -> Tuple[bytes, str]:
+        raise NotImplementedError
+
+    async def delete(self, blob_id: str) -> None:
+        raise NotImplementedError
+
+
+class GridFSBlobStore(BlobStore):
+    """Stores blobs in a MongoDB GridFS bucket"""
+
+    def __init__(self, db, bucket_name: str = "blobs"):
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name)
+        self.files = db[f"{bucket_name}.files"]
+
+    async def put(self, data: bytes, content_type: str) -> str:
+        blob_id = blob_id_for(data)
+        if await self.files.find_one({"_id": blob_id}, {"_id": 1}):
+            return blob_id
+        try:
+            await self.bucket.upload_from_stream_with_id(
+                blob_id, blob_id, data, metadata={"content_type": content_type}
+            )
+        except (FileExists, DuplicateKeyError):
+            # A concurrent writer stored the same content first
+            pass
+        return blob_id
+
+    async def get(self, blob_id: str) -> Tuple[bytes, str]:
+        try:
+            stream = await self.bucket.open_download_stream(blob_id)
+        except NoFile:
+            raise BlobNotFound(blob_id)
+        data = await stream.read()
+        metadata = stream.metadata or {}
+        return data, metadata.get("content_type", "application/octet-stream")
+
+    async def delete(self, blob_id: str) -> None:
+        try:
+            await self.bucket.delete(blob_id)
+        except NoFile:
+            pass
+
+
+class LocalBlobStore(BlobStore):
+    """Stores blobs as files under a local directory"""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def _path(self, blob_id: str) -> Path:
+        if not BLOB_ID_PATTERN.match(blob_id):
+            raise BlobNotFound(blob_id)
+        return self.root / blob_id[:2] / blob_id
+
+    def _write(self, blob_id: str, data: bytes, content_type: str) -> None:
+        path = self._path(blob_id)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # The type goes first so a reader that sees the blob always finds its type
+        self._replace(path.with_suffix(".type"), content_type.encode())
+        self._replace(path, data)
+
+    @staticmethod
+    def _replace(path: Path, data: bytes) -> None:
+        """Write path atomically through a temp file of its own, so concurrent writers don't collide"""
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f"{path.name}.", suffix=".tmp", delete=False) as tmp:
+            tmp.write(data)
+        try:
+            os.replace(tmp.name, path)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+
+    def _read(self, blob_id: str) -> Tuple[bytes, str]:
+        path = self._path(blob_id)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            raise BlobNotFound(blob_id)
+        type_path = path.with_suffix(".type")
+        content_type = type_path.read_text() if type_path.exists() else "application/octet-stream"
+        return data, content_type
+
+    def _delete(self, blob_id: str) -> None:
+        path = self._path(blob_id)
+        path.unlink(missing_ok=True)
+        path.with_suffix(".type").unlink(missing_ok=True)
+
+    async def put(self, data: bytes, content_type: str) -> str:
+        blob_id = blob_id_for(data)
+        await asyncio.to_thread(self._write, blob_id, data, content_type)
+        return blob_id
+
+    async def get(self, blob_id: str) -> Tuple[bytes, str]:
+        return await asyncio.to_thread(self._read, blob_id)
+
+    async def delete(self, blob_id: str) -> None:
+        await asyncio.to_thread(self._delete, blob_id)
+
+
+def create_blob_store(db) -> BlobStore:
+    """Build the blob store selected by the BLOB_STORE environment variable"""
+    backend = os.environ.get("BLOB_STORE", "gridfs")
+    if backend == "gridfs":
+        return GridFSBlobStore(db, os.environ.get("BLOB_STORE_BUCKET", "blobs"))
+    if backend == "local":
+        return LocalBlobStore(os.environ.get("BLOB_STORE_PATH", "blobs"))
+    raise ValueError(f"Unknown BLOB_STORE backend: {backend}")
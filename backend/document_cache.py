@@ -0,0 +1,182 @@
+"""Read-through cache for single-document lookups.
+
+DocumentCache keeps up to maxsize documents for ttl_seconds in LRU order.
+Concurrent misses for the same key share one database read (single flight),
+and a read that was in flight while the key got invalidated is not cached,
+so a write is never followed by a stale hit in the same worker.
+
+Cached documents are shared between callers and must not be mutated.
+
+With several uvicorn workers, CacheInvalidationChannel broadcasts
+invalidations through a small capped collection that every worker tails;
+without it, other workers see a write once their entry expires.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+from metrics import CACHE_HIT_RATIO, CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+Loader = Callable[[], Awaitable[Optional[dict]]]
+
+
+class DocumentCache:
+    def __init__(self, name: str, maxsize: int = 1024, ttl_seconds: float = 60):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.channel: Optional["CacheInvalidationChannel"] = None
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Bumped when a key is invalidated during its load, so that load's result is discarded
+        self._generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _record(self, result: str) -> None:
+        CACHE_REQUESTS.labels(self.name, result).inc()
+        if result == "miss":
+            self.misses += 1
+        else:
+            self.hits += 1
+        CACHE_HIT_RATIO.labels(self.name).set(self.hits / (self.hits + self.misses))
+
+    async def get(self, key: str, loader: Loader) -> Optional[dict]:
+        """Return the cached document for key, calling loader on a miss; None is never cached"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, document = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self._record("hit")
+                return document
+            del self._entries[key]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._record("coalesced")
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+                # The request that was loading went away; load on our own behalf
+                return await loader()
+
+        self._record("miss")
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        generation = self._generations.get(key, 0)
+        try:
+            document = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters get the error; make sure it isn't also reported as never retrieved
+            future.exception()
+            raise
+        else:
+            future.set_result(document)
+            if document is not None and self._generations.get(key, 0) == generation:
+                self._store(key, document)
+            return document
+        finally:
+            del self._inflight[key]
+            # Only in-flight loads need the generation; don't let the map grow without bound
+            self._generations.pop(key, None)
+
+    def _store(self, key: str, document: dict) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, document)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, key: str) -> None:
+        """Drop key from this worker only"""
+        self._entries.pop(key, None)
+        if key in self._inflight:
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    async def invalidate(self, key: str) -> None:
+        """Drop key here and, when a channel is attached, in every other worker"""
+        self.discard(key)
+        if self.channel is not None:
+            try:
+                await self.channel.publish(self.name, key)
+            except Exception as e:
+                logger.error(f"Could not broadcast {self.name} cache invalidation: {e}")
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class CacheInvalidationChannel:
+    """Broadcasts cache invalidations between workers through a tailable capped collection"""
+
+    def __init__(self, db, collection_name: str = "cache_invalidations", size_bytes: int = 1024 * 1024):
+        self.db = db
+        self.collection_name = collection_name
+        self.size_bytes = size_bytes
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.caches: Dict[str, DocumentCache] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def attach(self, cache: DocumentCache) -> None:
+        cache.channel = self
+        self.caches[cache.name] = cache
+
+    async def publish(self, cache_name: str, key: str) -> None:
+        await self.db[self.collection_name].insert_one(
+            {"cache": cache_name, "key": key, "origin": self.worker_id, "at": datetime.utcnow()}
+        )
+
+    async def start(self) -> None:
+        if self._task is None:
+            try:
+                await self.db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+            except CollectionInvalid:
+                pass
+            self._task = asyncio.create_task(self._run(datetime.utcnow()))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, since: datetime) -> None:
+        while True:
+            try:
+                cursor = self.db[self.collection_name].find(
+                    {"at": {"$gte": since}, "origin": {"$ne": self.worker_id}},
+                    cursor_type=CursorType.TAILABLE_AWAIT,
+                )
+                while cursor.alive:
+                    async for message in cursor:
+                        since = max(since, message["at"])
+                        cache = self.caches.get(message["cache"])
+                        if cache is not None:
+                            cache.discard(message["key"])
+                    # A tailable cursor on an empty collection dies at once; don't spin
+                    await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Cache invalidation channel error: {e}")
+                await asyncio.sleep(5)
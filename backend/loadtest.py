@@ -0,0 +1,328 @@
+"""Load test of the API against a seeded local database.
+
+Seeds a synthetic clinic (patients, anamneses with signatures, appointments
+and their notifications) into a local mongod, or into an in-memory stand-in
+(mongomock-motor) with --mongo-url memory, then drives the FastAPI app
+in-process with concurrent async clients. For every endpoint it reports
+p50/p95/p99 latency and requests per second as JSON, so runs can be diffed
+between commits.
+
+Usage:
+    python loadtest.py [--mongo-url mongodb://localhost:27017] [--patients 1000]
+                       [--concurrency 16] [--requests 500] [--output results.json]
+
+The database named by --db-name is dropped before seeding.
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+FIRST_NAMES = ["Maria", "José", "Ana", "João", "Antônio", "Francisca", "Carlos", "Paulo", "Lúcia", "Márcia"]
+LAST_NAMES = ["Silva", "Santos", "Oliveira", "Souza", "Rodrigues", "Ferreira", "Alves", "Pereira", "Lima", "Gomes"]
+CITIES = [("São Paulo", "SP"), ("Campinas", "SP"), ("Rio de Janeiro", "RJ"), ("Belo Horizonte", "MG")]
+APPOINTMENT_TIMES = ["08:00", "09:00", "10:00", "11:00", "14:00", "15:00", "16:00", "17:00"]
+SEED_START = datetime(2030, 1, 7)
+
+Request = Tuple[str, str, Optional[dict]]
+
+
+def connect(mongo_url: str, db_name: str):
+    """Point server at the target database before it is imported"""
+    memory = mongo_url == "memory"
+    os.environ["MONGO_URL"] = "mongodb://localhost:27017" if memory else mongo_url
+    os.environ["DB_NAME"] = db_name
+    os.environ.pop("NOTIFICATION_SENDER", None)
+    if memory:
+        os.environ["BLOB_STORE"] = "local"
+        os.environ["BLOB_STORE_PATH"] = tempfile.mkdtemp(prefix="loadtest-blobs-")
+
+    import server
+
+    if memory:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            raise SystemExit("--mongo-url memory needs mongomock-motor: pip install -r requirements-dev.txt")
+        server.client = AsyncMongoMockClient()
+        server.db = server.client[db_name]
+        server.blob_store = server.create_blob_store(server.db)
+        server.transactions_supported = False
+    return server
+
+
+def signature_data_url(rng: random.Random) -> str:
+    # A PNG header followed by noise is enough to exercise storage and serving
+    data = b"\x89PNG\r\n\x1a\n" + rng.randbytes(rng.randint(2048, 8192))
+    return "data:image/png;base64," + base64.b64encode(data).decode()
+
+
+def synthetic_patient(server, rng: random.Random, index: int) -> dict:
+    city, state = rng.choice(CITIES)
+    patient = server.Patient(
+        name=f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}",
+        address=f"Rua {rng.choice(LAST_NAMES)}, {rng.randint(1, 2000)}",
+        neighborhood="Centro",
+        city=city,
+        state=state,
+        cep=f"{rng.randint(10000, 99999)}-{rng.randint(0, 999):03d}",
+        birth_date=f"{rng.randint(1940, 2005)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        sex=rng.choice(["F", "M"]),
+        profession="Autônomo",
+        contact=f"(11) 9{rng.randint(1000, 9999)}-{index % 10000:04d}",
+        created_at=SEED_START - timedelta(minutes=index),
+    ).dict()
+    return {**patient, **server.patient_search_keys(patient)}
+
+
+def synthetic_anamnesis(server, rng: random.Random, patient: dict) -> dict:
+    general_data = server.GeneralData(
+        chief_complaint="Unha encravada",
+        podiatrist_frequency="Mensal",
+        medications=rng.random() < 0.4,
+        medication_details="",
+        allergies=rng.random() < 0.2,
+        allergy_details="",
+        work_position=rng.choice(["Em pé", "Sentado"]),
+        insoles=False,
+        smoking=rng.random() < 0.1,
+        pregnant=False,
+        breastfeeding=False,
+        physical_activity=rng.random() < 0.5,
+        physical_activity_frequency="",
+        footwear_type="Tênis",
+        daily_footwear_type="Sapato fechado",
+    )
+    clinical_data = server.ClinicalData(diabetes=rng.random() < 0.3, hipertensao=rng.random() < 0.3)
+    term = server.ResponsibilityTerm(
+        patient_name=patient["name"],
+        rg="12.345.678-9",
+        cpf="123.456.789-00",
+        signature=signature_data_url(rng),
+        date=SEED_START.strftime("%Y-%m-%d"),
+    )
+    return server.Anamnesis(
+        patient_id=patient["id"],
+        general_data=general_data,
+        clinical_data=clinical_data,
+        responsibility_term=term,
+    ).dict()
+
+
+async def seed(server, rng: random.Random, args) -> Dict[str, List[dict]]:
+    """Write a synthetic clinic in the same shape the API stores, return the seeded documents"""
+    await server.client.drop_database(args.db_name)
+    try:
+        await server.ensure_indexes()
+    except Exception as e:
+        logging.warning(f"Could not create indexes: {e}")
+
+    patients = [synthetic_patient(server, rng, index) for index in range(args.patients)]
+    anamneses, appointments, notifications = [], [], []
+    slots = [
+        (SEED_START + timedelta(days=day)).strftime("%Y-%m-%d") + " " + appointment_time
+        for day in range(365) if (SEED_START + timedelta(days=day)).weekday() < 5
+        for appointment_time in APPOINTMENT_TIMES
+    ]
+    rng.shuffle(slots)
+    for patient in patients:
+        for _ in range(args.anamneses_per_patient):
+            anamnesis = synthetic_anamnesis(server, rng, patient)
+            await server.store_signature(anamnesis["responsibility_term"])
+            anamneses.append(anamnesis)
+        for _ in range(args.appointments_per_patient):
+            if not slots:
+                break
+            date, appointment_time = slots.pop().split(" ")
+            appointment = server.Appointment(
+                patient_id=patient["id"], patient_name=patient["name"], date=date, time=appointment_time
+            )
+            appointment.starts_at = server.parse_appointment_datetime(date, appointment_time)
+            appointments.append(server.appointment_document(appointment))
+            notifications.extend(server.build_automatic_notifications(appointment.dict(), patient))
+
+    for collection, documents in (
+        (server.db.patients, patients),
+        (server.db.anamnesis, anamneses),
+        (server.db.appointments, appointments),
+        (server.db.notifications, notifications),
+    ):
+        for start in range(0, len(documents), 1000):
+            await collection.insert_many(documents[start:start + 1000], ordered=False)
+
+    return {"patients": patients, "anamnesis": anamneses, "appointments": appointments}
+
+
+def scenarios(seeded: Dict[str, List[dict]], rng: random.Random) -> Dict[str, Callable[[int], Request]]:
+    """Request factories per endpoint; each is called with the request number"""
+    patients, anamneses = seeded["patients"], seeded["anamnesis"]
+
+    def any_patient() -> dict:
+        return rng.choice(patients)
+
+    def week_range(number: int) -> Tuple[str, str]:
+        start = SEED_START + timedelta(weeks=number % 52)
+        return start.isoformat(), (start + timedelta(weeks=1)).isoformat()
+
+    booking_numbers = itertools.count()
+
+    def new_booking(number: int) -> Request:
+        # A distinct quarter hour per request, outside the seeded year, so bookings never conflict
+        starts_at = datetime(2040, 1, 1) + timedelta(minutes=15 * next(booking_numbers))
+        patient = any_patient()
+        return "POST", "/api/appointments", {
+            "patient_id": patient["id"],
+            "patient_name": patient["name"],
+            "date": starts_at.strftime("%Y-%m-%d"),
+            "time": starts_at.strftime("%H:%M"),
+            "duration_minutes": 15,
+        }
+
+    factories: Dict[str, Callable[[int], Request]] = {
+        "list_patients": lambda n: ("GET", "/api/patients?limit=100", None),
+        "list_patients_1000": lambda n: ("GET", "/api/patients?limit=1000", None),
+        "get_patient": lambda n: ("GET", f"/api/patients/{any_patient()['id']}", None),
+        "search_patients": lambda n: ("GET", f"/api/search/patients?q={any_patient()['name'].split()[0][:3]}", None),
+        "patient_anamnesis": lambda n: ("GET", f"/api/anamnesis/{any_patient()['id']}", None),
+        "anamnesis_summary": lambda n: ("GET", f"/api/anamnesis/{any_patient()['id']}?view=summary", None),
+        "appointments_week": lambda n: ("GET", "/api/appointments?from={}&to={}".format(*week_range(n)), None),
+        "patient_appointments": lambda n: ("GET", f"/api/appointments/{any_patient()['id']}", None),
+        "pending_notifications": lambda n: ("GET", "/api/notifications/pending", None),
+        "upcoming_notifications": lambda n: ("GET", "/api/notifications/upcoming", None),
+        "availability_week": lambda n: ("POST", "/api/availability", dict(zip(("from", "to"), week_range(n)))),
+        "create_appointment": new_booking,
+    }
+    if anamneses:
+        factories["anamnesis_signature"] = lambda n: ("GET", f"/api/anamnesis/{rng.choice(anamneses)['id']}/signature", None)
+    return factories
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+async def run_endpoint(client: httpx.AsyncClient, factory: Callable[[int], Request], requests: int, concurrency: int) -> dict:
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    counter = iter(range(requests))
+
+    async def worker():
+        for number in counter:
+            method, path, body = factory(number)
+            started = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            await response.aread()
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": sum(count for status, count in statuses.items() if not status.startswith("2")),
+        "statuses": statuses,
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "max_ms": round(latencies[-1], 3) if latencies else 0.0,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+async def main(args) -> Dict[str, Any]:
+    server = connect(args.mongo_url, args.db_name)
+    rng = random.Random(args.seed)
+
+    started = time.perf_counter()
+    seeded = await seed(server, rng, args)
+    seed_seconds = time.perf_counter() - started
+
+    factories = scenarios(seeded, rng)
+    selected = args.endpoints.split(",") if args.endpoints else list(factories)
+    unknown = [name for name in selected if name not in factories]
+    if unknown:
+        raise SystemExit(f"Unknown endpoints: {', '.join(unknown)}")
+
+    results: Dict[str, Any] = {}
+    limits = httpx.Limits(max_connections=args.concurrency)
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", limits=limits, timeout=60) as client:
+        for name in selected:
+            # Warm-up requests are not measured
+            await run_endpoint(client, factories[name], min(args.concurrency, args.requests), args.concurrency)
+            results[name] = await run_endpoint(client, factories[name], args.requests, args.concurrency)
+            logging.info(f"{name}: {results[name]['p50_ms']} ms p50, {results[name]['rps']} rps")
+
+    if args.mongo_url != "memory":
+        await server.client.drop_database(args.db_name)
+
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "backend": "memory" if args.mongo_url == "memory" else "mongod",
+        "config": {
+            "patients": args.patients,
+            "anamneses_per_patient": args.anamneses_per_patient,
+            "appointments_per_patient": args.appointments_per_patient,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "seed": args.seed,
+        },
+        "seed_seconds": round(seed_seconds, 2),
+        "endpoints": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-url", default=os.environ.get("LOADTEST_MONGO_URL", "mongodb://localhost:27017"),
+                        help="mongod to seed, or 'memory' for the in-memory stand-in")
+    parser.add_argument("--db-name", default="podologia_loadtest")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--anamneses-per-patient", type=int, default=1)
+    parser.add_argument("--appointments-per-patient", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per endpoint")
+    parser.add_argument("--endpoints", default="", help="comma-separated subset of endpoints to run")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    report = json.dumps(asyncio.run(main(args)), indent=2)
+    if args.output:
+        Path(args.output).write_text(report + "\n")
+    else:
+        print(report)
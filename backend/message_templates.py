@@ -0,0 +1,156 @@
+"""WhatsApp reminder templates.
+
+Notifications store only the version of the template they were created with.
+The message text and wa.me link are rendered when needed and memoized in a
+bounded LRU, so wording can change without rewriting stored notifications.
+"""
+import urllib.parse
+from datetime import datetime
+from functools import lru_cache
+from string import Formatter
+from typing import Dict, Tuple
+
+TEMPLATE_FIELDS = {"patient_name", "formatted_date", "appointment_time"}
+
+MESSAGE_CACHE_SIZE = 4096
+
+
+def format_date(appointment_date: str) -> str:
+    """Format a YYYY-MM-DD date in the Brazilian DD/MM/YYYY format"""
+    try:
+        return datetime.strptime(appointment_date, "%Y-%m-%d").strftime("%d/%m/%Y")
+    except ValueError:
+        return appointment_date
+
+
+class MessageTemplate:
+    def __init__(self, notification_type: str, version: int, text: str):
+        # Parse once up front so that a typo in a placeholder fails at import, not at send time
+        fields = {field for _, field, _, _ in Formatter().parse(text) if field}
+        unknown = fields - TEMPLATE_FIELDS
+        if unknown:
+            raise ValueError(f"Unknown template fields: {', '.join(sorted(unknown))}")
+        self.notification_type = notification_type
+        self.version = version
+        self.text = text
+
+    def render(self, patient_name: str, appointment_date: str, appointment_time: str) -> str:
+        return self.text.format(
+            patient_name=patient_name,
+            formatted_date=format_date(appointment_date),
+            appointment_time=appointment_time
+        )
+
+
+TEMPLATES: Dict[Tuple[str, int], MessageTemplate] = {}
+
+# Version given to newly created notifications
+CURRENT_TEMPLATE_VERSION = 1
+
+
+def register_template(template: MessageTemplate) -> None:
+    TEMPLATES[(template.notification_type, template.version)] = template
+
+
+register_template(MessageTemplate("1_day_before", 1, """🦶 *Lembrete de Consulta - Podologia*
+
+Olá {patient_name}! 👋
+
+Este é um lembrete de que você tem uma consulta agendada para *amanhã* ({formatted_date}) às *{appointment_time}*.
+
+Por favor, confirme sua presença respondendo:
+✅ *CONFIRMO* - se você comparecerá
+❌ *CANCELAR* - se precisar cancelar
+
+📍 Não se esqueça de trazer documentos e chegar com 10 minutos de antecedência.
+
+Obrigado!"""))
+
+register_template(MessageTemplate("1_hour_30_before", 1, """🦶 *Lembrete de Consulta - Podologia*
+
+Olá {patient_name}! 👋
+
+Sua consulta está próxima! 
+
+📅 Data: *{formatted_date}*
+🕐 Horário: *{appointment_time}*
+
+Você tem aproximadamente *1h30* para se preparar.
+
+Por favor, confirme que está a caminho respondendo:
+✅ *A CAMINHO* - se você está se dirigindo ao local
+❌ *ATRASO* - se você vai se atrasar
+❌ *CANCELAR* - se não puder comparecer
+
+📍 Lembre-se de chegar com 10 minutos de antecedência.
+
+Até logo!"""))
+
+
+def create_whatsapp_link(phone: str, message: str) -> str:
+    """Create WhatsApp link with pre-filled message"""
+    # Clean phone number (remove non-digits)
+    clean_phone = ''.join(filter(str.isdigit, phone))
+    
+    # Add Brazil country code if not present
+    if not clean_phone.startswith('55'):
+        clean_phone = '55' + clean_phone
+    
+    # URL encode the message
+    encoded_message = urllib.parse.quote(message)
+    
+    return f"https://wa.me/{clean_phone}?text={encoded_message}"
+
+
+@lru_cache(maxsize=MESSAGE_CACHE_SIZE)
+def render_message(
+    template_version: int,
+    notification_type: str,
+    patient_name: str,
+    appointment_date: str,
+    appointment_time: str
+) -> str:
+    template = TEMPLATES.get((notification_type, template_version))
+    if template is None:
+        # Any type other than 1_day_before has always used the 1h30 reminder
+        template = TEMPLATES[("1_hour_30_before", template_version)]
+    return template.render(patient_name, appointment_date, appointment_time)
+
+
+@lru_cache(maxsize=MESSAGE_CACHE_SIZE)
+def render_whatsapp_link(
+    template_version: int,
+    notification_type: str,
+    patient_name: str,
+    appointment_date: str,
+    appointment_time: str,
+    phone: str
+) -> str:
+    message = render_message(template_version, notification_type, patient_name, appointment_date, appointment_time)
+    return create_whatsapp_link(phone, message)
+
+
+def notification_message(notification: dict) -> str:
+    """Message text of a stored notification; rows written before templates carry their own"""
+    if notification.get("template_version") is None:
+        return notification.get("message", "")
+    return render_message(
+        notification["template_version"],
+        notification["notification_type"],
+        notification["patient_name"],
+        notification["appointment_date"],
+        notification["appointment_time"]
+    )
+
+
+def notification_whatsapp_link(notification: dict) -> str:
+    if notification.get("template_version") is None:
+        return create_whatsapp_link(notification["patient_contact"], notification.get("message", ""))
+    return render_whatsapp_link(
+        notification["template_version"],
+        notification["notification_type"],
+        notification["patient_name"],
+        notification["appointment_date"],
+        notification["appointment_time"],
+        notification["patient_contact"]
+    )
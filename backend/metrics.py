@@ -0,0 +1,148 @@
+"""Prometheus metrics for HTTP requests and MongoDB commands.
+
+MetricsMiddleware times every request under its route template (so
+/api/patients/{patient_id} is one series, not one per patient) and tracks
+requests in flight. MongoCommandMetrics is a pymongo CommandListener that
+times every command the driver sends, per collection and command name.
+Document caches count their hits and misses here too. All of it is exposed
+by metrics_response() in the Prometheus text format.
+
+With several worker processes, set PROMETHEUS_MULTIPROC_DIR to a writable,
+empty directory so /metrics aggregates every worker.
+"""
+import os
+import time
+from typing import Dict, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from pymongo import monitoring
+from starlette.responses import Response
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "HTTP requests being handled",
+    ["method", "route"],
+    multiprocess_mode="livesum",
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds",
+    "MongoDB command latency as seen by the driver",
+    ["collection", "command"],
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "mongodb_command_failures_total",
+    "MongoDB commands that returned an error",
+    ["collection", "command"],
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Document cache lookups by result (hit, coalesced, miss)",
+    ["cache", "result"],
+)
+CACHE_HIT_RATIO = Gauge(
+    "cache_hit_ratio",
+    "Share of document cache lookups served without a database read, per worker",
+    ["cache"],
+    multiprocess_mode="liveall",
+)
+
+# Handshake and monitoring commands that would only add noise
+IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "buildInfo", "saslStart", "saslContinue", "endSessions"}
+
+
+def command_collection(command_name: str, command: dict) -> str:
+    """Collection a command targets, or "" for database-level commands"""
+    if command_name == "getMore":
+        return str(command.get("collection", ""))
+    target = command.get(command_name)
+    return target if isinstance(target, str) else ""
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Records driver command timings per collection and command name"""
+
+    def __init__(self):
+        # The collection is only on the started event; keep it until the command finishes
+        self._pending: Dict[Tuple[int, object], str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if event.command_name not in IGNORED_COMMANDS:
+            self._pending[(event.request_id, event.connection_id)] = command_collection(event.command_name, event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        collection = self._pending.pop((event.request_id, event.connection_id), None)
+        if collection is not None:
+            MONGO_COMMAND_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        collection = self._pending.pop((event.request_id, event.connection_id), None)
+        if collection is not None:
+            MONGO_COMMAND_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+            MONGO_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and in-flight requests per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def route_template(self, scope) -> str:
+        router = scope["app"].router
+        for route in router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        # Unmatched paths share one series so scanners can't blow up cardinality
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = self.route_template(scope)
+        status = 500
+        in_progress = HTTP_REQUESTS_IN_PROGRESS.labels(method, route)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_progress.dec()
+            HTTP_REQUEST_DURATION.labels(method, route, str(status)).observe(time.perf_counter() - started)
+
+
+def metrics_response() -> Response:
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,126 @@
+"""One-shot data migrations.
+
+Usage, from the backend directory:
+
+    python migrations.py signatures starts_at slot_keys
+"""
+import asyncio
+import sys
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from availability import slot_keys
+from server import DEFAULT_APPOINTMENT_MINUTES, client, db, logger, parse_appointment_datetime, store_signature
+
+
+async def migrate_signatures(batch_size: int = 100):
+    """Move inline base64 signatures out of anamnesis documents into the blob store"""
+    migrated = 0
+    skipped = 0
+    cursor = db.anamnesis.find(
+        {"responsibility_term.signature": {"$nin": ["", None]}},
+        {"_id": 1, "id": 1, "responsibility_term.signature": 1}
+    ).batch_size(batch_size)
+    batch = []
+    async for anamnesis in cursor:
+        try:
+            term = await store_signature(dict(anamnesis["responsibility_term"]))
+        except ValueError as e:
+            # Left inline, so one undecodable image can't block every later row
+            skipped += 1
+            logger.warning(f"Skipping signature of anamnesis {anamnesis.get('id', anamnesis['_id'])}: {e}")
+            continue
+        batch.append(UpdateOne(
+            {"_id": anamnesis["_id"]},
+            {"$set": {
+                "responsibility_term.signature": "",
+                "responsibility_term.signature_id": term["signature_id"]
+            }}
+        ))
+        if len(batch) >= batch_size:
+            migrated += (await db.anamnesis.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        migrated += (await db.anamnesis.bulk_write(batch, ordered=False)).modified_count
+    logger.info(f"Moved {migrated} signatures to the blob store ({skipped} could not be decoded)")
+
+
+async def migrate_starts_at(batch_size: int = 500):
+    """Store the combined starts_at datetime on appointments written before it existed"""
+    migrated = 0
+    skipped = 0
+    cursor = db.appointments.find(
+        {"starts_at": {"$exists": False}},
+        {"_id": 1, "date": 1, "time": 1}
+    ).batch_size(batch_size)
+    batch = []
+    async for appointment in cursor:
+        try:
+            starts_at = parse_appointment_datetime(appointment.get("date", ""), appointment.get("time", ""))
+        except ValueError:
+            skipped += 1
+            starts_at = None
+        batch.append(UpdateOne({"_id": appointment["_id"]}, {"$set": {"starts_at": starts_at}}))
+        if len(batch) >= batch_size:
+            migrated += (await db.appointments.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        migrated += (await db.appointments.bulk_write(batch, ordered=False)).modified_count
+    logger.info(f"Backfilled starts_at on {migrated} appointments ({skipped} with unparseable date/time)")
+
+
+async def migrate_slot_keys(batch_size: int = 500):
+    """Add slot keys to upcoming appointments so that new bookings cannot overlap them"""
+    migrated = 0
+    conflicts = 0
+    cursor = db.appointments.find(
+        {
+            "starts_at": {"$gte": datetime.utcnow()},
+            "slot_keys": {"$exists": False},
+            "status": {"$ne": "cancelled"}
+        },
+        {"_id": 1, "starts_at": 1, "duration_minutes": 1}
+    ).batch_size(batch_size)
+
+    async def flush(batch):
+        nonlocal migrated, conflicts
+        try:
+            migrated += (await db.appointments.bulk_write(batch, ordered=False)).modified_count
+        except BulkWriteError as e:
+            migrated += e.details["nModified"]
+            conflicts += len(e.details["writeErrors"])
+
+    batch = []
+    async for appointment in cursor:
+        keys = slot_keys(appointment["starts_at"], appointment.get("duration_minutes", DEFAULT_APPOINTMENT_MINUTES))
+        batch.append(UpdateOne({"_id": appointment["_id"]}, {"$set": {"slot_keys": keys}}))
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    logger.info(f"Added slot keys to {migrated} appointments ({conflicts} overlap an existing booking)")
+
+
+MIGRATIONS = {
+    "signatures": migrate_signatures,
+    "starts_at": migrate_starts_at,
+    "slot_keys": migrate_slot_keys,
+}
+
+
+async def main(names):
+    try:
+        for name in names:
+            await MIGRATIONS[name]()
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or any(name not in MIGRATIONS for name in sys.argv[1:]):
+        print(f"Usage: python migrations.py {{{','.join(MIGRATIONS)}}}...")
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1:]))
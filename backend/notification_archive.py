@@ -0,0 +1,93 @@
+"""Background mover of finished notifications into a cold archive collection.
+
+Sent notifications, and unsent ones whose appointment is long past, are copied
+to notifications_archive in batches and then removed from the hot collection.
+A TTL index on archived_at deletes them for good after the retention period.
+Moving is idempotent, so several workers can run it at once.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationArchiver:
+    def __init__(
+        self,
+        db,
+        expire_after: timedelta = timedelta(days=2),
+        interval_seconds: float = 300,
+        batch_size: int = 500,
+    ):
+        self.db = db
+        self.expire_after = expire_after
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def archivable_queries(self, now: datetime):
+        return [
+            {"sent": True},
+            # Never sent, and the appointment it was for is over
+            {"sent": False, "scheduled_time": {"$lt": now - self.expire_after}},
+        ]
+
+    async def archive_batch(self, query: dict, now: datetime) -> int:
+        notifications = await self.db.notifications.find(query).limit(self.batch_size).to_list(self.batch_size)
+        if not notifications:
+            return 0
+
+        for notification in notifications:
+            notification["archived_at"] = now
+        try:
+            await self.db.notifications_archive.insert_many(notifications, ordered=False)
+        except BulkWriteError as e:
+            # Already archived by an earlier, interrupted run or by another worker
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+        result = await self.db.notifications.delete_many(
+            {"_id": {"$in": [notification["_id"] for notification in notifications]}}
+        )
+        return result.deleted_count
+
+    async def run_once(self) -> int:
+        """Archive everything archivable now and return how many notifications were moved"""
+        now = datetime.utcnow()
+        moved = 0
+        for query in self.archivable_queries(now):
+            while True:
+                batch = await self.archive_batch(query, now)
+                moved += batch
+                if batch < self.batch_size:
+                    break
+        if moved:
+            logger.info(f"Archived {moved} notifications")
+        return moved
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Notification archiver error: {e}")
+            await asyncio.sleep(self.interval_seconds)
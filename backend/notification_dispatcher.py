@@ -0,0 +1,210 @@
+"""In-process dispatcher that sends due notifications through a pluggable sender.
+
+Every uvicorn worker runs its own dispatcher. A notification is claimed with an
+atomic find_one_and_update that sets claimed_by/lease_until, so only one worker
+sends it; a claim whose lease expires (e.g. the worker died mid-send) becomes
+claimable again.
+
+Reminders that come due more than a grace period ago are skipped, so turning
+the dispatcher on against an old queue doesn't tell patients about
+appointments that are already over; the archiver moves them out later. A
+notification that keeps failing is parked with failed: True after
+max_attempts sends, and is left for the clinic to send by hand.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import requests
+from pymongo import ASCENDING, ReturnDocument
+
+from message_templates import notification_message
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationSender:
+    """Interface implemented by every notification transport"""
+
+    async def send(self, notification: dict) -> None:
+        raise NotImplementedError
+
+
+class LogSender(NotificationSender):
+    """Only logs the notification, for development"""
+
+    async def send(self, notification: dict) -> None:
+        logger.info(
+            f"Sending {notification['notification_type']} notification {notification['id']} "
+            f"to {notification['patient_contact']}"
+        )
+
+
+class FakeSender(NotificationSender):
+    """Keeps sent notifications in memory, for tests"""
+
+    def __init__(self):
+        self.sent: List[dict] = []
+
+    async def send(self, notification: dict) -> None:
+        self.sent.append(notification)
+
+
+class WebhookSender(NotificationSender):
+    """POSTs the notification as JSON to a messaging gateway"""
+
+    def __init__(self, url: str, timeout: float = 10):
+        self.url = url
+        self.timeout = timeout
+
+    def _post(self, payload: dict) -> None:
+        response = requests.post(self.url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+
+    async def send(self, notification: dict) -> None:
+        payload = {
+            "id": notification["id"],
+            "patient_contact": notification["patient_contact"],
+            "notification_type": notification["notification_type"],
+            "message": notification.get("message", ""),
+        }
+        await asyncio.to_thread(self._post, payload)
+
+
+class NotificationDispatcher:
+    def __init__(
+        self,
+        db,
+        sender: NotificationSender,
+        lease_seconds: float = 60,
+        retry_seconds: float = 300,
+        max_idle_seconds: float = 30,
+        grace_seconds: float = 90 * 60,
+        max_attempts: int = 5,
+    ):
+        self.db = db
+        self.sender = sender
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease = timedelta(seconds=lease_seconds)
+        self.retry = timedelta(seconds=retry_seconds)
+        self.max_idle_seconds = max_idle_seconds
+        # The 1h30 reminder is useless once its appointment has started
+        self.grace = timedelta(seconds=grace_seconds)
+        self.max_attempts = max_attempts
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _sendable(self, now: datetime) -> dict:
+        return {
+            "sent": False,
+            "failed": {"$ne": True},
+            "scheduled_time": {"$gte": now - self.grace},
+            # Never claimed, or claimed with a lease that expired
+            "lease_until": {"$not": {"$gte": now}},
+        }
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self) -> None:
+        """Re-evaluate the next due time, e.g. after new notifications were booked"""
+        self._wake.set()
+
+    async def claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        query = self._sendable(now)
+        query["scheduled_time"]["$lte"] = now
+        return await self.db.notifications.find_one_and_update(
+            query,
+            {"$set": {"claimed_by": self.worker_id, "lease_until": now + self.lease}},
+            sort=[("scheduled_time", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def dispatch(self, notification: dict) -> None:
+        owned = {"id": notification["id"], "claimed_by": self.worker_id}
+        try:
+            notification["message"] = notification_message(notification)
+            await self.sender.send(notification)
+        except Exception as e:
+            attempts = notification.get("attempts", 0) + 1
+            if attempts >= self.max_attempts:
+                logger.error(f"Giving up on notification {notification['id']} after {attempts} attempts: {e}")
+                update = {"$set": {"failed": True, "attempts": attempts}, "$unset": {"claimed_by": "", "lease_until": ""}}
+            else:
+                logger.error(f"Failed to send notification {notification['id']}: {e}")
+                update = {"$set": {"lease_until": datetime.utcnow() + self.retry, "attempts": attempts}}
+            await self.db.notifications.update_one(owned, update)
+            return
+        await self.db.notifications.update_one(
+            owned,
+            {"$set": {"sent": True, "sent_at": datetime.utcnow()}, "$unset": {"claimed_by": "", "lease_until": ""}},
+        )
+
+    async def seconds_until_next(self) -> float:
+        now = datetime.utcnow()
+        upcoming = await self.db.notifications.find_one(
+            self._sendable(now),
+            {"scheduled_time": 1},
+            sort=[("scheduled_time", ASCENDING)],
+        )
+        if not upcoming:
+            return self.max_idle_seconds
+        delay = (upcoming["scheduled_time"] - now).total_seconds()
+        return min(max(delay, 0), self.max_idle_seconds)
+
+    async def run_once(self) -> int:
+        """Send every notification that is due now and return how many were claimed"""
+        claimed = 0
+        while True:
+            notification = await self.claim()
+            if notification is None:
+                return claimed
+            claimed += 1
+            await self.dispatch(notification)
+
+    async def _run(self) -> None:
+        logger.info(f"Notification dispatcher {self.worker_id} started")
+        while True:
+            self._wake.clear()
+            try:
+                await self.run_once()
+                delay = await self.seconds_until_next()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Notification dispatcher error: {e}")
+                delay = self.max_idle_seconds
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+def create_sender() -> Optional[NotificationSender]:
+    """Build the sender selected by NOTIFICATION_SENDER; None keeps sending manual"""
+    backend = os.environ.get("NOTIFICATION_SENDER", "")
+    if not backend:
+        return None
+    if backend == "log":
+        return LogSender()
+    if backend == "fake":
+        return FakeSender()
+    if backend == "webhook":
+        return WebhookSender(os.environ["NOTIFICATION_WEBHOOK_URL"])
+    raise ValueError(f"Unknown NOTIFICATION_SENDER: {backend}")
@@ -0,0 +1,178 @@
+"""In-process pub/sub that announces notifications as they become due.
+
+One broker task per worker sleeps until the next scheduled_time (or until a
+booking wakes it), reads the notifications that became due since the last
+check with a single query and fans them out to every subscriber queue, so
+idle subscribers cost no database work at all.
+
+A notification can also be booked already due, behind the scan position,
+e.g. the 1h30 reminder of an appointment an hour away, by any worker. Each
+scan therefore also reads the unsent notifications created since the
+previous scan (by created_at, minus a margin for clock skew and slow
+commits) that the position has already passed. While anyone is subscribed
+the broker checks at least every poll_seconds, so bookings made by other
+workers reach its subscribers promptly.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from pymongo import ASCENDING
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationBroker:
+    def __init__(
+        self,
+        db,
+        max_idle_seconds: float = 60,
+        poll_seconds: float = 5,
+        created_margin_seconds: float = 30,
+        queue_size: int = 100,
+        batch_size: int = 500,
+    ):
+        self.db = db
+        self.max_idle_seconds = max_idle_seconds
+        self.poll_seconds = poll_seconds
+        self.created_margin = timedelta(seconds=created_margin_seconds)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.subscribers: Set[asyncio.Queue] = set()
+        # (scheduled_time, id) of the last notification announced by the scan
+        self._last_key: Optional[Tuple[datetime, str]] = None
+        # Start of the previous scan; later bookings behind _last_key are read by created_at
+        self._created_since: Optional[datetime] = None
+        # Recently created notifications already announced -> created_at; the
+        # created_at windows overlap, so the late scan must skip these
+        self._recent: Dict[str, datetime] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._created_since = datetime.utcnow()
+            self._last_key = (self._created_since, "")
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for queue in list(self.subscribers):
+            self._close(queue)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+
+    def _close(self, queue: asyncio.Queue) -> None:
+        # None tells the subscriber to end its stream; it resumes with Last-Event-ID
+        self.subscribers.discard(queue)
+        while True:
+            try:
+                queue.put_nowait(None)
+                return
+            except asyncio.QueueFull:
+                queue.get_nowait()
+
+    def publish(self, notification: dict) -> None:
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(notification)
+            except asyncio.QueueFull:
+                logger.warning("Dropping slow notification stream subscriber")
+                self._close(queue)
+
+    def booked(self, notifications: Iterable[dict]) -> None:
+        """Re-plan the next wake-up after new notifications were booked in this worker"""
+        self._wake.set()
+
+    async def publish_late(self, now: datetime) -> None:
+        """Announce notifications created since the previous scan whose due time the scan already passed"""
+        since = self._created_since - self.created_margin
+        self._created_since = now
+        last_time, last_id = self._last_key
+        notifications = await self.db.notifications.find(
+            {"sent": False, "created_at": {"$gte": since}, "scheduled_time": {"$lte": last_time}}
+        ).sort([("scheduled_time", ASCENDING), ("id", ASCENDING)]).to_list(None)
+        for notification in notifications:
+            if (notification["scheduled_time"], notification["id"]) <= self._last_key:
+                self._announce(notification)
+        # The next window starts at now - margin; nothing created before it can come back
+        self._recent = {
+            notification_id: created_at
+            for notification_id, created_at in self._recent.items()
+            if created_at >= now - self.created_margin
+        }
+
+    def _announce(self, notification: dict) -> None:
+        if notification["id"] in self._recent:
+            return
+        created_at = notification.get("created_at")
+        if created_at is not None and created_at >= self._created_since - self.created_margin:
+            self._recent[notification["id"]] = created_at
+        self.publish(notification)
+
+    async def publish_due(self) -> None:
+        now = datetime.utcnow()
+        await self.publish_late(now)
+        while True:
+            last_time, last_id = self._last_key
+            notifications = await self.db.notifications.find(
+                {
+                    "sent": False,
+                    "scheduled_time": {"$lte": now},
+                    "$or": [
+                        {"scheduled_time": {"$gt": last_time}},
+                        {"scheduled_time": last_time, "id": {"$gt": last_id}}
+                    ]
+                }
+            ).sort([("scheduled_time", ASCENDING), ("id", ASCENDING)]).limit(self.batch_size).to_list(self.batch_size)
+            for notification in notifications:
+                self._announce(notification)
+            if notifications:
+                self._last_key = (notifications[-1]["scheduled_time"], notifications[-1]["id"])
+            if len(notifications) < self.batch_size:
+                # Everything up to now is announced; don't rescan it on the next wake-up
+                self._last_key = max(self._last_key, (now, ""))
+                return
+
+    async def seconds_until_next(self) -> float:
+        now = datetime.utcnow()
+        upcoming = await self.db.notifications.find_one(
+            {"sent": False, "scheduled_time": {"$gt": now}},
+            {"scheduled_time": 1},
+            sort=[("scheduled_time", ASCENDING)],
+        )
+        # Bookings by other workers only show up when we look
+        idle = self.poll_seconds if self.subscribers else self.max_idle_seconds
+        if not upcoming:
+            return idle
+        return min((upcoming["scheduled_time"] - now).total_seconds(), idle)
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            try:
+                await self.publish_due()
+                delay = await self.seconds_until_next()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Notification broker error: {e}")
+                delay = self.max_idle_seconds
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
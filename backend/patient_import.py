@@ -0,0 +1,142 @@
+"""Streaming parsers and field normalizers for bulk patient imports.
+
+The request body is read chunk by chunk and split into complete records as
+they arrive, so an upload of any size is parsed with memory bounded by one
+chunk (plus one record that straddles two chunks). Records that can't be
+parsed are yielded as ImportParseError values, so a bad row is reported
+without failing the rest of the file.
+"""
+import codecs
+import csv
+import io
+import json
+import re
+from typing import AsyncIterator, Optional, Tuple, Union
+
+# A record longer than this without a line break is not a patient row
+MAX_RECORD_LENGTH = 1024 * 1024
+
+
+class ImportParseError(Exception):
+    pass
+
+
+Record = Union[dict, ImportParseError]
+
+
+def complete_length(text: str, quoted: bool) -> int:
+    """Length of the prefix of text made of complete lines.
+
+    With quoted (CSV), a line break inside a quoted field doesn't end a record.
+    """
+    end = text.rfind("\n")
+    if quoted:
+        while end != -1 and text.count('"', 0, end) % 2:
+            end = text.rfind("\n", 0, end)
+    return end + 1
+
+
+async def text_blocks(chunks: AsyncIterator[bytes], quoted: bool) -> AsyncIterator[str]:
+    """Decode a byte stream (with or without a UTF-8 BOM) into blocks of complete records"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    try:
+        async for chunk in chunks:
+            pending += decoder.decode(chunk)
+            cut = complete_length(pending, quoted)
+            if cut:
+                yield pending[:cut]
+                pending = pending[cut:]
+            if len(pending) > MAX_RECORD_LENGTH:
+                raise ImportParseError("Record too long; is the file CSV or NDJSON?")
+        pending += decoder.decode(b"", final=True)
+    except UnicodeDecodeError as e:
+        # The records that end before the bad byte are still good
+        pending += e.object[:e.start].decode("utf-8")
+        cut = complete_length(pending, quoted)
+        if cut:
+            yield pending[:cut]
+        raise ImportParseError("File is not valid UTF-8")
+    if pending.strip():
+        yield pending
+
+
+async def ndjson_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Record]]:
+    """(row number, record) for every non-blank line of an NDJSON stream"""
+    row = 0
+    async for block in text_blocks(chunks, quoted=False):
+        # Not splitlines(): U+2028 and friends are valid inside JSON strings
+        for line in block.split("\n"):
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield row, ImportParseError(f"Invalid JSON: {e}")
+                continue
+            if not isinstance(record, dict):
+                yield row, ImportParseError("Each line must be a JSON object")
+                continue
+            yield row, record
+
+
+async def csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Record]]:
+    """(row number, record) for every data row of a CSV stream whose first row is the header"""
+    header: Optional[list] = None
+    row = 0
+    async for block in text_blocks(chunks, quoted=True):
+        for values in csv.reader(io.StringIO(block, newline="")):
+            if not any(value.strip() for value in values):
+                continue
+            if header is None:
+                header = [value.strip() for value in values]
+                continue
+            row += 1
+            if len(values) != len(header):
+                yield row, ImportParseError(f"Expected {len(header)} columns, found {len(values)}")
+                continue
+            yield row, dict(zip(header, values))
+
+
+def digits(value: str) -> str:
+    return "".join(filter(str.isdigit, value or ""))
+
+
+def normalize_cep(value: str) -> str:
+    """12345678 or 12.345-678 -> 12345-678; anything that isn't 8 digits is kept as typed"""
+    number = digits(value)
+    if len(number) == 8:
+        return f"{number[:5]}-{number[5:]}"
+    return (value or "").strip()
+
+
+DAY_FIRST_DATE = re.compile(r"^(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})$")
+
+
+def normalize_birth_date(value: str) -> str:
+    """10/03/1975, 10-03-1975 or 10.03.1975 -> 1975-03-10, as the form stores it; anything else kept as typed"""
+    value = (value or "").strip()
+    match = DAY_FIRST_DATE.match(value)
+    if match:
+        day, month, year = match.groups()
+        return f"{year}-{int(month):02d}-{int(day):02d}"
+    return value
+
+
+def national_phone(value: str) -> str:
+    """Digits of a Brazilian phone without the +55 country code"""
+    number = digits(value)
+    if number.startswith("55") and len(number) > 11:
+        number = number[2:]
+    return number
+
+
+def normalize_phone(value: str) -> str:
+    """Brazilian landlines and mobiles as (11) 3456-7890 / (11) 91234-5678; other contacts kept as typed"""
+    number = national_phone(value)
+    if len(number) == 11:
+        return f"({number[:2]}) {number[2:7]}-{number[7:]}"
+    if len(number) == 10:
+        return f"({number[:2]}) {number[2:6]}-{number[6:]}"
+    return (value or "").strip()
@@ -1,25 +1,89 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, Body, Header, HTTPException, Query, Request, Response
 from dotenv import load_dotenv
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DeleteMany, IndexModel, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from availability import SLOT_KEY_MINUTES, free_slots, slot_keys
+from blob_store import BlobNotFound, blob_id_for, create_blob_store
+from document_cache import CacheInvalidationChannel, DocumentCache
+from metrics import MetricsMiddleware, MongoCommandMetrics, metrics_response
+from message_templates import CURRENT_TEMPLATE_VERSION, notification_message, notification_whatsapp_link
+from notification_archive import NotificationArchiver
+from notification_dispatcher import NotificationDispatcher, create_sender
+from notification_stream import NotificationBroker
+from patient_import import (
+    ImportParseError,
+    csv_records,
+    ndjson_records,
+    national_phone,
+    normalize_birth_date,
+    normalize_cep,
+    normalize_phone,
+)
+from slow_queries import SlowQueryLog
 import os
+import re
+import asyncio
+import json
+import base64
+import csv
+import io
 import logging
+import unicodedata
+import orjson
+from functools import lru_cache
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, create_model
+from typing import List, Optional, Dict, Any, Tuple, Union
 import uuid
 from datetime import datetime, timedelta
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Queries slower than SLOW_QUERY_MS are kept for /api/admin/slow-queries, a sample of them explained
+slow_query_log = SlowQueryLog(
+    threshold_ms=float(os.environ.get("SLOW_QUERY_MS", "100")),
+    explain_sample_rate=float(os.environ.get("SLOW_QUERY_EXPLAIN_RATE", "0.1"))
+)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics(), slow_query_log])
 db = client[os.environ['DB_NAME']]
 
+# Signature images and other binary attachments
+blob_store = create_blob_store(db)
+
+# Background sender for due notifications, disabled unless NOTIFICATION_SENDER is set
+notification_sender = create_sender()
+dispatcher = NotificationDispatcher(db, notification_sender) if notification_sender else None
+
+# Moves sent and expired notifications to notifications_archive, where a TTL index deletes them
+NOTIFICATION_ARCHIVE_RETENTION_DAYS = int(os.environ.get("NOTIFICATION_ARCHIVE_RETENTION_DAYS", "365"))
+archiver = NotificationArchiver(db)
+
+# Announces notifications to /notifications/stream subscribers as they become due
+broker = NotificationBroker(db)
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_REPLAY_LIMIT = 500
+
+# Read-through caches for single patient and anamnesis lookups, invalidated on write
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", "60"))
+patient_cache = DocumentCache("patients", ttl_seconds=CACHE_TTL_SECONDS)
+anamnesis_cache = DocumentCache("anamnesis", ttl_seconds=CACHE_TTL_SECONDS)
+
+# With several workers, CACHE_INVALIDATION=mongo makes a write clear the caches of every worker
+cache_channel = CacheInvalidationChannel(db) if os.environ.get("CACHE_INVALIDATION") == "mongo" else None
+if cache_channel:
+    cache_channel.attach(patient_cache)
+    cache_channel.attach(anamnesis_cache)
+
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -37,11 +101,13 @@ class Patient(BaseModel):
     sex: str
     profession: str
     contact: str
+    cpf: str = ""
+    version: int = 0  # incremented by every update, served as the ETag
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class PatientCreate(BaseModel):
-    name: str
+    name: str = Field(..., min_length=1)
     address: str
     neighborhood: str
     city: str
@@ -51,6 +117,63 @@ class PatientCreate(BaseModel):
     sex: str
     profession: str
     contact: str
+    cpf: str = ""
+
+# Patient search keys
+def normalize_text(value: str) -> str:
+    """Lowercase and strip accents so that "João" and "joao" compare equal"""
+    decomposed = unicodedata.normalize("NFKD", value or "")
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+def only_digits(value: str) -> str:
+    return "".join(filter(str.isdigit, value or ""))
+
+def name_tokens(value: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", normalize_text(value))
+
+def phone_keys(phone: str) -> List[str]:
+    """Digits-only phone, plus the same number without country and area code"""
+    digits = only_digits(phone)
+    keys = [digits]
+    if digits.startswith("55") and len(digits) > 11:
+        digits = digits[2:]
+        keys.append(digits)
+    if len(digits) > 9:
+        keys.append(digits[2:])
+    return [key for key in dict.fromkeys(keys) if key]
+
+def patient_dedupe_keys(patient: dict) -> List[str]:
+    """A patient repeats another with the same normalized name and the same birth date or phone"""
+    name = " ".join(name_tokens(patient.get("name", "")))
+    keys = []
+    birth_date = normalize_birth_date(patient.get("birth_date", ""))
+    if birth_date:
+        keys.append(f"birth_date:{name}:{birth_date}")
+    phone = national_phone(patient.get("contact", ""))
+    if phone:
+        keys.append(f"contact:{name}:{phone}")
+    return keys
+
+def patient_search_keys(patient: dict) -> dict:
+    """Normalized keys stored alongside a patient and served by the search indexes"""
+    return {
+        "search_name": sorted(set(name_tokens(patient.get("name", "")))),
+        "search_phone": phone_keys(patient.get("contact", "")),
+        "search_cpf": only_digits(patient.get("cpf", "")),
+        "dedupe_keys": patient_dedupe_keys(patient),
+    }
+
+def rank_search_result(patient: dict, tokens: List[str], digits: str) -> Tuple[int, str]:
+    """Sort key for search results: exact matches first, then alphabetical"""
+    score = 0
+    names = patient.get("search_name", [])
+    for token in tokens:
+        score += 2 if token in names else 1
+    if tokens and normalize_text(patient.get("name", "")).startswith(" ".join(tokens)):
+        score += 3
+    if digits and (digits in patient.get("search_phone", []) or digits == patient.get("search_cpf")):
+        score += 3
+    return -score, normalize_text(patient.get("name", ""))
 
 # Anamnesis Models
 class GeneralData(BaseModel):
@@ -106,9 +229,18 @@ class ResponsibilityTerm(BaseModel):
     patient_name: str
     rg: str
     cpf: str
-    signature: str  # base64 encoded signature image
+    signature: str = ""  # base64 data URL, only accepted on write and moved to the blob store
+    signature_id: Optional[str] = None  # blob store id, served by /anamnesis/{id}/signature
     date: str
 
+class ObservationEntry(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    text: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class ObservationEntryCreate(BaseModel):
+    text: str = Field(..., min_length=1)
+
 class Anamnesis(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     patient_id: str
@@ -116,6 +248,8 @@ class Anamnesis(BaseModel):
     clinical_data: ClinicalData
     responsibility_term: ResponsibilityTerm
     observations: str = ""  # Campo para observações dos procedimentos
+    observation_entries: List[ObservationEntry] = []  # appended one at a time after each procedure
+    version: int = 0  # incremented by every update, served as the ETag
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -126,6 +260,143 @@ class AnamnesisCreate(BaseModel):
     responsibility_term: ResponsibilityTerm
     observations: str = ""
 
+# Clinical flags shown in the patient history sidebar
+SUMMARY_RISK_FLAGS = (
+    "diabetes",
+    "insulin",
+    "neuropatia",
+    "alteracoes_comprometimento_vasculares",
+    "cardiopatia",
+    "marca_passo",
+    "quimioterapia_radioterapia",
+)
+
+class AnamnesisSummary(BaseModel):
+    id: str
+    patient_id: str
+    chief_complaint: str = ""
+    risk_flags: List[str] = []
+    created_at: datetime
+
+def summary_projection() -> dict:
+    projection = {"_id": 0, "id": 1, "patient_id": 1, "created_at": 1, "general_data.chief_complaint": 1}
+    for flag in SUMMARY_RISK_FLAGS:
+        projection[f"clinical_data.{flag}"] = 1
+    return projection
+
+def anamnesis_summary(anamnesis: dict) -> AnamnesisSummary:
+    clinical_data = anamnesis.get("clinical_data", {})
+    return AnamnesisSummary(
+        id=anamnesis["id"],
+        patient_id=anamnesis["patient_id"],
+        chief_complaint=anamnesis.get("general_data", {}).get("chief_complaint", ""),
+        risk_flags=[flag for flag in SUMMARY_RISK_FLAGS if clinical_data.get(flag)],
+        created_at=anamnesis["created_at"]
+    )
+
+def anamnesis_field_paths() -> set:
+    """Every field path that may be requested through fields= on the anamnesis list"""
+    paths = set(Anamnesis.model_fields)
+    for name in ("general_data", "clinical_data", "responsibility_term"):
+        nested = Anamnesis.model_fields[name].annotation
+        paths.update(f"{name}.{field}" for field in nested.model_fields)
+    paths.discard("responsibility_term.signature")
+    return paths
+
+ANAMNESIS_FIELD_PATHS = anamnesis_field_paths()
+# The whole term would include the inline signature of documents not migrated yet
+RESPONSIBILITY_TERM_PATHS = sorted(
+    path for path in ANAMNESIS_FIELD_PATHS if path.startswith("responsibility_term.")
+)
+
+def fields_projection(fields: str) -> dict:
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in ANAMNESIS_FIELD_PATHS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    projection = {"_id": 0, "id": 1}
+    for field in requested:
+        if field == "responsibility_term":
+            projection.update({path: 1 for path in RESPONSIBILITY_TERM_PATHS})
+        else:
+            projection[field] = 1
+    return projection
+
+@lru_cache(maxsize=None)
+def partial_model(model):
+    """model with every field optional, nested models included, to validate projected documents"""
+    fields = {}
+    for name, info in model.model_fields.items():
+        annotation = info.annotation
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            annotation = partial_model(annotation)
+        fields[name] = (Optional[annotation], None)
+    return create_model(f"Partial{model.__name__}", **fields)
+
+# Partial updates
+ANAMNESIS_SECTIONS = ("general_data", "clinical_data", "responsibility_term")
+ANAMNESIS_PATCHABLE = {"observations", *ANAMNESIS_SECTIONS}
+
+@lru_cache(maxsize=None)
+def field_adapter(model, field: str) -> TypeAdapter:
+    return TypeAdapter(model.model_fields[field].annotation)
+
+def patch_value(model, field: str, value: Any, path: str) -> Any:
+    info = model.model_fields.get(field)
+    if info is None or path == "responsibility_term.signature_id":
+        raise HTTPException(status_code=400, detail=f"Field cannot be patched: {path}")
+    if value is None:
+        # In a merge patch null removes a member; here a field can only go back to its default
+        if info.is_required():
+            raise HTTPException(status_code=400, detail=f"Field cannot be removed: {path}")
+        return info.get_default(call_default_factory=True)
+    try:
+        return field_adapter(model, field).validate_python(value)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid value for {path}: {e.errors()[0]['msg']}")
+
+def anamnesis_patch_paths(patch: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate a JSON merge patch of an anamnesis and turn it into dotted $set paths"""
+    updates = {}
+    for key, value in patch.items():
+        if key not in ANAMNESIS_PATCHABLE:
+            raise HTTPException(status_code=400, detail=f"Field cannot be patched: {key}")
+        if key not in ANAMNESIS_SECTIONS:
+            updates[key] = patch_value(Anamnesis, key, value, key)
+            continue
+        if not isinstance(value, dict):
+            raise HTTPException(status_code=400, detail=f"{key} must be an object")
+        section = Anamnesis.model_fields[key].annotation
+        for field, field_value in value.items():
+            updates[f"{key}.{field}"] = patch_value(section, field, field_value, f"{key}.{field}")
+    return updates
+
+# Signature storage
+def decode_data_url(value: str) -> Tuple[bytes, str]:
+    """Decode a base64 data URL (or bare base64 PNG) into bytes and content type"""
+    content_type = "image/png"
+    if value.startswith("data:"):
+        header, _, value = value.partition(",")
+        content_type = header[len("data:"):].split(";")[0] or content_type
+    try:
+        data = base64.b64decode(value + "=" * (-len(value) % 4), validate=True)
+    except Exception:
+        raise ValueError("Invalid signature image")
+    if not data:
+        raise ValueError("Invalid signature image")
+    return data, content_type
+
+# Excluded from client payloads, so an anamnesis can't point at another patient's blob
+SIGNATURE_ID = {"responsibility_term": {"signature_id"}}
+
+async def store_signature(term: dict) -> dict:
+    """Move an inline signature into the blob store, keeping only its id on the term"""
+    if term.get("signature"):
+        data, content_type = decode_data_url(term["signature"])
+        term["signature_id"] = await blob_store.put(data, content_type)
+        term["signature"] = ""
+    return term
+
 # Notification Models
 class Notification(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -137,77 +408,29 @@ class Notification(BaseModel):
     scheduled_time: datetime
     appointment_date: str
     appointment_time: str
-    message: str
+    message: str = ""  # rendered from the template on read; only stored on legacy rows
+    template_version: Optional[int] = None
     sent: bool = False
+    failed: bool = False  # set by the dispatcher after repeated send errors; send by hand
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class NotificationCreate(BaseModel):
     appointment_id: str
     notification_type: str
 
-# WhatsApp Message Templates
-def generate_whatsapp_message(patient_name: str, appointment_date: str, appointment_time: str, notification_type: str) -> str:
-    """Generate WhatsApp message based on notification type"""
-    
-    # Format date to Brazilian format
-    try:
-        date_obj = datetime.strptime(appointment_date, "%Y-%m-%d")
-        formatted_date = date_obj.strftime("%d/%m/%Y")
-    except:
-        formatted_date = appointment_date
-    
-    if notification_type == "1_day_before":
-        message = f"""🦶 *Lembrete de Consulta - Podologia*
-
-Olá {patient_name}! 👋
-
-Este é um lembrete de que você tem uma consulta agendada para *amanhã* ({formatted_date}) às *{appointment_time}*.
-
-Por favor, confirme sua presença respondendo:
-✅ *CONFIRMO* - se você comparecerá
-❌ *CANCELAR* - se precisar cancelar
-
-📍 Não se esqueça de trazer documentos e chegar com 10 minutos de antecedência.
-
-Obrigado!"""
-    
-    else:  # 1_hour_30_before
-        message = f"""🦶 *Lembrete de Consulta - Podologia*
-
-Olá {patient_name}! 👋
+class MarkSentRequest(BaseModel):
+    ids: List[str] = Field(min_length=1, max_length=500)
 
-Sua consulta está próxima! 
+class MarkSentResult(BaseModel):
+    id: str
+    status: str  # "marked", "already_sent" or "not_found"
 
-📅 Data: *{formatted_date}*
-🕐 Horário: *{appointment_time}*
+# Appointment Models
+DEFAULT_APPOINTMENT_MINUTES = int(os.environ.get("APPOINTMENT_MINUTES", "60"))
+MAX_APPOINTMENT_MINUTES = 480
+MAX_AVAILABILITY_DAYS = 92
+MAX_SERIES_OCCURRENCES = 52
 
-Você tem aproximadamente *1h30* para se preparar.
-
-Por favor, confirme que está a caminho respondendo:
-✅ *A CAMINHO* - se você está se dirigindo ao local
-❌ *ATRASO* - se você vai se atrasar
-❌ *CANCELAR* - se não puder comparecer
-
-📍 Lembre-se de chegar com 10 minutos de antecedência.
-
-Até logo!"""
-    
-    return message
-
-def create_whatsapp_link(phone: str, message: str) -> str:
-    """Create WhatsApp link with pre-filled message"""
-    # Clean phone number (remove non-digits)
-    clean_phone = ''.join(filter(str.isdigit, phone))
-    
-    # Add Brazil country code if not present
-    if not clean_phone.startswith('55'):
-        clean_phone = '55' + clean_phone
-    
-    # URL encode the message
-    import urllib.parse
-    encoded_message = urllib.parse.quote(message)
-    
-    return f"https://wa.me/{clean_phone}?text={encoded_message}"
 class Appointment(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     patient_id: str
@@ -215,6 +438,9 @@ class Appointment(BaseModel):
     date: str
     time: str
     status: str = "scheduled"  # scheduled, confirmed, completed, cancelled
+    starts_at: Optional[datetime] = None  # date and time combined, set on write
+    duration_minutes: int = DEFAULT_APPOINTMENT_MINUTES
+    series_id: Optional[str] = None  # set on appointments booked as a recurring series
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class AppointmentCreate(BaseModel):
@@ -222,6 +448,208 @@ class AppointmentCreate(BaseModel):
     patient_name: str
     date: str
     time: str
+    duration_minutes: int = Field(DEFAULT_APPOINTMENT_MINUTES, ge=SLOT_KEY_MINUTES, le=MAX_APPOINTMENT_MINUTES)
+
+class AppointmentUpdate(BaseModel):
+    date: Optional[str] = None
+    time: Optional[str] = None
+    duration_minutes: Optional[int] = Field(None, ge=SLOT_KEY_MINUTES, le=MAX_APPOINTMENT_MINUTES)
+    status: Optional[str] = Field(None, pattern="^(scheduled|confirmed|completed|cancelled)$")
+
+class RecurrenceRule(BaseModel):
+    interval: int = Field(ge=1, le=52)
+    unit: str = Field("weeks", pattern="^(days|weeks)$")
+    count: Optional[int] = Field(None, ge=1, le=MAX_SERIES_OCCURRENCES)
+    until: Optional[str] = None  # YYYY-MM-DD, inclusive
+
+class AppointmentSeriesCreate(AppointmentCreate):
+    recurrence: RecurrenceRule
+
+class AppointmentSeries(BaseModel):
+    series_id: str
+    appointments: List[Appointment]
+
+def expand_recurrence(first: datetime, rule: RecurrenceRule) -> List[datetime]:
+    """Start times of every occurrence of a recurring series, the first one included"""
+    if rule.count is None and rule.until is None:
+        raise ValueError("Recurrence needs a count or an until date")
+    step = timedelta(days=rule.interval) if rule.unit == "days" else timedelta(weeks=rule.interval)
+    until = datetime.strptime(rule.until, "%Y-%m-%d") + timedelta(days=1) if rule.until else None
+    if until is not None and until <= first:
+        raise ValueError("until is before the first occurrence")
+    
+    occurrences = []
+    current = first
+    while (rule.count is None or len(occurrences) < rule.count) and (until is None or current < until):
+        if len(occurrences) == MAX_SERIES_OCCURRENCES:
+            raise ValueError(f"A series can have at most {MAX_SERIES_OCCURRENCES} occurrences")
+        occurrences.append(current)
+        current += step
+    return occurrences
+
+# Availability Models
+class WorkingPeriod(BaseModel):
+    weekday: int = Field(ge=0, le=6)  # 0 = Monday
+    start: str  # HH:MM
+    end: str  # HH:MM
+
+DEFAULT_WORKING_HOURS = [
+    *[WorkingPeriod(weekday=weekday, start="08:00", end="18:00") for weekday in range(5)],
+    WorkingPeriod(weekday=5, start="08:00", end="12:00"),
+]
+
+class BlockedPeriod(BaseModel):
+    starts_at: datetime
+    ends_at: datetime
+    reason: str = ""
+
+class AvailabilityQuery(BaseModel):
+    from_: datetime = Field(alias="from")
+    to: datetime
+    slot_minutes: int = Field(DEFAULT_APPOINTMENT_MINUTES, ge=SLOT_KEY_MINUTES, le=MAX_APPOINTMENT_MINUTES)
+    working_hours: List[WorkingPeriod] = Field(default_factory=lambda: list(DEFAULT_WORKING_HOURS))
+    blocked_periods: List[BlockedPeriod] = []
+
+class AvailableSlot(BaseModel):
+    starts_at: datetime
+    ends_at: datetime
+
+def parse_appointment_datetime(date: str, time: str) -> datetime:
+    """Combine an appointment's date (YYYY-MM-DD) and time (HH:MM) strings"""
+    return datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
+
+# Cursor pagination helpers
+def encode_cursor(sort_value: datetime, doc_id: str) -> str:
+    """Encode a (sort_value, id) keyset position as an opaque cursor"""
+    payload = json.dumps([sort_value.isoformat(), doc_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Decode a cursor produced by encode_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, doc_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(sort_value), str(doc_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def keyset_filter(cursor: Optional[str], sort_field: str = "created_at") -> dict:
+    """Build the query that resumes a (sort_field, id) ordered scan after cursor"""
+    if not cursor:
+        return {}
+    sort_value, doc_id = decode_cursor(cursor)
+    return {
+        "$or": [
+            {sort_field: {"$gt": sort_value}},
+            {sort_field: sort_value, "id": {"$gt": doc_id}}
+        ]
+    }
+
+async def keyset_page(
+    collection,
+    query: dict,
+    sort_field: str,
+    limit: int,
+    cursor: Optional[str],
+    response: Response
+) -> List[dict]:
+    """Fetch one (sort_field, id) ordered page and put the next page's cursor in X-Next-Cursor"""
+    documents = await collection.find({**query, **keyset_filter(cursor, sort_field)}) \
+        .sort([(sort_field, ASCENDING), ("id", ASCENDING)]) \
+        .limit(limit + 1) \
+        .to_list(limit + 1)
+
+    if len(documents) > limit:
+        documents = documents[:limit]
+        last = documents[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last[sort_field], last["id"])
+
+    return documents
+
+@lru_cache(maxsize=None)
+def list_adapter(model) -> TypeAdapter:
+    return TypeAdapter(List[model])
+
+def model_list_response(
+    model,
+    documents: List[dict],
+    response: Optional[Response] = None,
+    exclude_unset: bool = False
+) -> ORJSONResponse:
+    """Validate raw documents against model in one pass and serialize them with orjson.
+
+    Returning the response directly skips FastAPI's second response_model
+    validation and jsonable_encoder walk; the route's response_model still
+    documents the schema. Headers set on the injected response are kept.
+    With exclude_unset, fields missing from the documents are left out.
+    """
+    adapter = list_adapter(model)
+    headers = None
+    if response is not None:
+        headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+    content = adapter.dump_python(adapter.validate_python(documents), exclude_unset=exclude_unset)
+    return ORJSONResponse(content, headers=headers)
+
+async def find_patient(patient_id: str) -> Optional[dict]:
+    """A stored patient through the patient cache; the result must not be mutated"""
+    return await patient_cache.get(patient_id, lambda: db.patients.find_one({"id": patient_id}, {"_id": 0}))
+
+async def find_anamnesis(anamnesis_id: str) -> Optional[dict]:
+    """A stored anamnesis through the anamnesis cache; the result must not be mutated"""
+    return await anamnesis_cache.get(anamnesis_id, lambda: db.anamnesis.find_one({"id": anamnesis_id}, {"_id": 0}))
+
+async def find_current(cache: DocumentCache, find, collection, document_id: str) -> Optional[dict]:
+    """find() through the cache, checked against the stored version before it is served with an ETag.
+
+    Another worker's write only reaches this worker's cache through
+    CACHE_INVALIDATION or the TTL; a stale version would make the client's
+    next If-Match fail with 412 even after reloading. The check reads just
+    the version, so a hit still saves loading the whole document.
+    """
+    document = await find(document_id)
+    if document is None:
+        return None
+    current = await collection.find_one({"id": document_id}, {"_id": 0, "version": 1})
+    if current is None:
+        cache.discard(document_id)
+        return None
+    if current.get("version", 0) != document.get("version", 0):
+        cache.discard(document_id)
+        document = await find(document_id)
+    return document
+
+# Optimistic concurrency: records carry a version that updates increment; clients
+# send it back in If-Match and get 412 if someone else updated the record first
+def version_etag(document: dict) -> str:
+    return f'"{document.get("version", 0)}"'
+
+def version_filter(if_match: Optional[str]) -> dict:
+    """Query clause matching the versions listed in an If-Match header; {} when absent or *"""
+    if not if_match or if_match.strip() == "*":
+        return {}
+    try:
+        versions = [int(tag.strip().removeprefix("W/").strip('"')) for tag in if_match.split(",")]
+    except ValueError:
+        raise HTTPException(status_code=412, detail="If-Match does not match the current version")
+    if 0 in versions:
+        # Records stored before versioning have no version field
+        versions.append(None)
+    return {"version": {"$in": versions}}
+
+async def raise_not_found_or_conflict(collection, document_id: str, detail: str):
+    """Explain why a conditional update matched nothing"""
+    if await collection.find_one({"id": document_id}, {"_id": 1}):
+        raise HTTPException(status_code=412, detail="Record was modified by someone else; reload and retry")
+    raise HTTPException(status_code=404, detail=detail)
+
+async def check_updatable(collection, document_id: str, if_match: Optional[str], detail: str):
+    """Fail with 404/412 before a side effect that a failed conditional update would orphan.
+
+    Used before uploading a signature: blobs are content addressed and may be
+    shared, so one uploaded for an update that then fails can't simply be deleted.
+    """
+    if not await collection.find_one({"id": document_id, **version_filter(if_match)}, {"_id": 1}):
+        await raise_not_found_or_conflict(collection, document_id, detail)
 
 # Patient endpoints
 @api_router.post("/patients", response_model=Patient)
@@ -229,45 +657,222 @@ async def create_patient(patient: PatientCreate):
     try:
         patient_dict = patient.dict()
         patient_obj = Patient(**patient_dict)
-        await db.patients.insert_one(patient_obj.dict())
+        await db.patients.insert_one({**patient_obj.dict(), **patient_search_keys(patient_dict)})
         return patient_obj
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @api_router.get("/patients", response_model=List[Patient])
-async def get_patients():
+async def get_patients(
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """List patients one page at a time, ordered by (created_at, id).
+
+    The cursor for the next page is returned in the X-Next-Cursor header and is
+    absent on the last page.
+    """
     try:
-        patients = await db.patients.find().to_list(1000)
-        return [Patient(**patient) for patient in patients]
+        patients = await keyset_page(db.patients, {}, "created_at", limit, cursor, response)
+        return model_list_response(Patient, patients, response)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @api_router.get("/patients/{patient_id}", response_model=Patient)
-async def get_patient(patient_id: str):
+async def get_patient(patient_id: str, response: Response):
     try:
-        patient = await db.patients.find_one({"id": patient_id})
+        patient = await find_current(patient_cache, find_patient, db.patients, patient_id)
         if not patient:
             raise HTTPException(status_code=404, detail="Patient not found")
+        response.headers["ETag"] = version_etag(patient)
         return Patient(**patient)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @api_router.put("/patients/{patient_id}", response_model=Patient)
-async def update_patient(patient_id: str, patient_update: PatientCreate):
+async def update_patient(
+    patient_id: str,
+    patient_update: PatientCreate,
+    response: Response,
+    if_match: Optional[str] = Header(None)
+):
+    """Replace a patient's data; with If-Match, only if the version still matches"""
     try:
         patient_dict = patient_update.dict()
+        patient_dict.update(patient_search_keys(patient_dict))
         patient_dict["updated_at"] = datetime.utcnow()
         
-        result = await db.patients.update_one(
-            {"id": patient_id},
-            {"$set": patient_dict}
+        updated_patient = await db.patients.find_one_and_update(
+            {"id": patient_id, **version_filter(if_match)},
+            {"$set": patient_dict, "$inc": {"version": 1}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
         )
         
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail="Patient not found")
+        if updated_patient is None:
+            await raise_not_found_or_conflict(db.patients, patient_id, "Patient not found")
+        await patient_cache.invalidate(patient_id)
         
-        updated_patient = await db.patients.find_one({"id": patient_id})
+        response.headers["ETag"] = version_etag(updated_patient)
         return Patient(**updated_patient)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Bulk import
+IMPORT_CHUNK_SIZE = 1000
+MAX_IMPORT_ERRORS = 1000
+
+class ImportRowError(BaseModel):
+    row: int  # 1-based data row, not counting the CSV header
+    errors: List[str] = []
+    duplicate_of: Optional[str] = None  # id of the existing patient this row repeats
+
+class ImportResult(BaseModel):
+    received: int = 0
+    imported: int = 0  # with dry_run, rows that would have been imported
+    duplicates: int = 0
+    invalid: int = 0
+    errors: List[ImportRowError] = []
+    errors_truncated: bool = False
+    dry_run: bool = False
+    # A problem with the file itself (bad encoding, a runaway record) that stopped
+    # the import; rows before it were imported and are counted above
+    error: Optional[str] = None
+
+    def report(self, row_error: ImportRowError):
+        if len(self.errors) < MAX_IMPORT_ERRORS:
+            self.errors.append(row_error)
+        else:
+            self.errors_truncated = True
+
+def normalize_import_row(record: dict) -> dict:
+    row = {key: value.strip() if isinstance(value, str) else value for key, value in record.items()}
+    if isinstance(row.get("cep"), str):
+        row["cep"] = normalize_cep(row["cep"])
+    if isinstance(row.get("contact"), str):
+        row["contact"] = normalize_phone(row["contact"])
+    if isinstance(row.get("birth_date"), str):
+        row["birth_date"] = normalize_birth_date(row["birth_date"])
+    return row
+
+async def find_import_duplicates(
+    pending: List[Tuple[int, dict, List[str]]],
+    seen: Dict[str, str],
+    result: ImportResult
+) -> List[Tuple[int, dict]]:
+    """Drop rows that repeat a stored patient or an earlier row and return the rest.
+
+    Stored patients are looked up for this chunk's keys only, through the
+    dedupe_keys index; seen holds the keys of earlier rows not yet written.
+    """
+    keys = {key for _, _, row_keys in pending for key in row_keys}
+    stored = {}
+    async for patient in db.patients.find({"dedupe_keys": {"$in": list(keys)}}, {"_id": 0, "id": 1, "dedupe_keys": 1}):
+        for key in patient["dedupe_keys"]:
+            stored.setdefault(key, patient["id"])
+    
+    batch = []
+    for row, patient, row_keys in pending:
+        duplicate_of = next((stored.get(key) or seen[key] for key in row_keys if key in stored or key in seen), None)
+        if duplicate_of:
+            result.duplicates += 1
+            result.report(ImportRowError(row=row, duplicate_of=duplicate_of))
+            continue
+        patient_obj = Patient(**patient)
+        for key in row_keys:
+            seen[key] = patient_obj.id
+        batch.append((row, {**patient_obj.dict(), **patient_search_keys(patient)}))
+    return batch
+
+async def import_chunk(pending: List[Tuple[int, dict, List[str]]], seen: Dict[str, str], result: ImportResult):
+    batch = await find_import_duplicates(pending, seen, result)
+    if batch:
+        await insert_import_batch(batch, result)
+    if not result.dry_run:
+        # Written rows are found by the next chunk's lookup
+        seen.clear()
+
+async def insert_import_batch(batch: List[Tuple[int, dict]], result: ImportResult):
+    if result.dry_run:
+        result.imported += len(batch)
+        return
+    try:
+        inserted = await db.patients.insert_many([document for _, document in batch], ordered=False)
+        result.imported += len(inserted.inserted_ids)
+    except BulkWriteError as e:
+        result.imported += e.details.get("nInserted", 0)
+        for write_error in e.details.get("writeErrors", []):
+            result.invalid += 1
+            result.report(ImportRowError(row=batch[write_error["index"]][0], errors=[write_error.get("errmsg", "")]))
+
+def import_format(content_type: str) -> Optional[str]:
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type in ("text/csv", "application/csv"):
+        return "csv"
+    if media_type in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        return "ndjson"
+    return None
+
+@api_router.post("/patients/import", response_model=ImportResult)
+async def import_patients(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    dry_run: bool = False
+):
+    """Import patients from a CSV (header row of PatientCreate fields) or NDJSON request body.
+
+    The body is parsed as it streams in. Rows are validated against
+    PatientCreate with CEP, phone and birth date normalized. In chunks of
+    IMPORT_CHUNK_SIZE, duplicates of stored patients (found by their
+    dedupe_keys) or of earlier rows are skipped, and the rest are written
+    with unordered insert_many. The result lists the errors
+    and duplicates of each row. If the file itself turns out to be unreadable
+    part way through, the rows before that point are kept and error says where
+    it stopped. With dry_run nothing is written.
+    """
+    format = format or import_format(request.headers.get("content-type", ""))
+    if not format:
+        raise HTTPException(status_code=400, detail="Send text/csv or application/x-ndjson, or pass format=")
+    
+    result = ImportResult(dry_run=dry_run)
+    try:
+        seen: Dict[str, str] = {}
+        records = csv_records(request.stream()) if format == "csv" else ndjson_records(request.stream())
+        pending: List[Tuple[int, dict, List[str]]] = []
+        try:
+            async for row, record in records:
+                result.received += 1
+                if isinstance(record, ImportParseError):
+                    result.invalid += 1
+                    result.report(ImportRowError(row=row, errors=[str(record)]))
+                    continue
+                
+                try:
+                    patient = PatientCreate(**normalize_import_row(record)).dict()
+                except ValidationError as e:
+                    result.invalid += 1
+                    result.report(ImportRowError(row=row, errors=[
+                        f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+                    ]))
+                    continue
+                
+                pending.append((row, patient, patient_dedupe_keys(patient)))
+                if len(pending) >= IMPORT_CHUNK_SIZE:
+                    await import_chunk(pending, seen, result)
+                    pending = []
+        except ImportParseError as e:
+            # Earlier chunks are already written; keep the rows parsed so far too and
+            # report the rest, so a re-run only has to skip them as duplicates
+            result.error = f"{e}; stopped after row {result.received}"
+        
+        if pending:
+            await import_chunk(pending, seen, result)
+        return result
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -275,6 +880,7 @@ async def update_patient(patient_id: str, patient_update: PatientCreate):
 async def delete_patient(patient_id: str):
     try:
         result = await db.patients.delete_one({"id": patient_id})
+        await patient_cache.invalidate(patient_id)
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Patient not found")
         return {"message": "Patient deleted successfully"}
@@ -285,129 +891,532 @@ async def delete_patient(patient_id: str):
 @api_router.post("/anamnesis", response_model=Anamnesis)
 async def create_anamnesis(anamnesis: AnamnesisCreate):
     try:
-        anamnesis_dict = anamnesis.dict()
+        # signature_id is only ever set by store_signature, never taken from the client
+        anamnesis_dict = anamnesis.dict(exclude=SIGNATURE_ID)
+        await store_signature(anamnesis_dict["responsibility_term"])
         anamnesis_obj = Anamnesis(**anamnesis_dict)
         await db.anamnesis.insert_one(anamnesis_obj.dict())
         return anamnesis_obj
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@api_router.get("/anamnesis/{patient_id}", response_model=List[Anamnesis])
-async def get_patient_anamnesis(patient_id: str):
+@api_router.get("/anamnesis/{patient_id}", response_model=Union[List[Anamnesis], List[AnamnesisSummary]])
+async def get_patient_anamnesis(
+    patient_id: str,
+    view: str = Query("full", pattern="^(full|summary)$"),
+    fields: Optional[str] = None
+):
+    """List a patient's anamnesis forms.
+
+    view=summary returns AnamnesisSummary items; fields=a,b.c returns only the
+    requested (dotted) field paths plus id. Both are projected in MongoDB.
+    """
+    try:
+        if fields:
+            projection = fields_projection(fields)
+            anamnesis_list = await db.anamnesis.find({"patient_id": patient_id}, projection).to_list(1000)
+            return model_list_response(partial_model(Anamnesis), anamnesis_list, exclude_unset=True)
+
+        if view == "summary":
+            anamnesis_list = await db.anamnesis.find({"patient_id": patient_id}, summary_projection()).to_list(1000)
+            return [anamnesis_summary(anamnesis) for anamnesis in anamnesis_list]
+
+        # Inline signatures of documents not migrated yet are served by the signature endpoint
+        anamnesis_list = await db.anamnesis.find(
+            {"patient_id": patient_id},
+            {"responsibility_term.signature": 0}
+        ).to_list(1000)
+        return model_list_response(Anamnesis, anamnesis_list)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.patch("/anamnesis/{anamnesis_id}", response_model=Anamnesis)
+async def patch_anamnesis(
+    anamnesis_id: str,
+    response: Response,
+    patch: Dict[str, Any] = Body(...),
+    if_match: Optional[str] = Header(None)
+):
+    """Apply a JSON merge patch (RFC 7396) to an anamnesis, writing only the fields it names.
+
+    {"clinical_data": {"diabetes": true}} becomes $set clinical_data.diabetes,
+    so a small edit needs neither the rest of the form nor the signature.
+    """
     try:
-        anamnesis_list = await db.anamnesis.find({"patient_id": patient_id}).to_list(1000)
-        return [Anamnesis(**anamnesis) for anamnesis in anamnesis_list]
+        updates = anamnesis_patch_paths(patch)
+        if "responsibility_term.signature" in updates:
+            await check_updatable(db.anamnesis, anamnesis_id, if_match, "Anamnesis not found")
+            term = await store_signature({"signature": updates.pop("responsibility_term.signature")})
+            updates.update({f"responsibility_term.{key}": value for key, value in term.items()})
+        updates["updated_at"] = datetime.utcnow()
+        
+        updated_anamnesis = await db.anamnesis.find_one_and_update(
+            {"id": anamnesis_id, **version_filter(if_match)},
+            {"$set": updates, "$inc": {"version": 1}},
+            projection={"_id": 0, "responsibility_term.signature": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        
+        if updated_anamnesis is None:
+            await raise_not_found_or_conflict(db.anamnesis, anamnesis_id, "Anamnesis not found")
+        await anamnesis_cache.invalidate(anamnesis_id)
+        
+        response.headers["ETag"] = version_etag(updated_anamnesis)
+        return Anamnesis(**updated_anamnesis)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.post("/anamnesis/{anamnesis_id}/observations", response_model=ObservationEntry)
+async def add_anamnesis_observation(
+    anamnesis_id: str,
+    entry: ObservationEntryCreate,
+    response: Response,
+    if_match: Optional[str] = Header(None)
+):
+    """Append one observation entry with $push, without rewriting the form"""
+    try:
+        observation = ObservationEntry(**entry.dict())
+        updated_anamnesis = await db.anamnesis.find_one_and_update(
+            {"id": anamnesis_id, **version_filter(if_match)},
+            {
+                "$push": {"observation_entries": observation.dict()},
+                "$set": {"updated_at": observation.created_at},
+                "$inc": {"version": 1}
+            },
+            projection={"_id": 0, "version": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        
+        if updated_anamnesis is None:
+            await raise_not_found_or_conflict(db.anamnesis, anamnesis_id, "Anamnesis not found")
+        await anamnesis_cache.invalidate(anamnesis_id)
+        
+        response.headers["ETag"] = version_etag(updated_anamnesis)
+        return observation
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @api_router.get("/anamnesis/form/{anamnesis_id}", response_model=Anamnesis)
-async def get_anamnesis(anamnesis_id: str):
+async def get_anamnesis(anamnesis_id: str, response: Response):
     try:
-        anamnesis = await db.anamnesis.find_one({"id": anamnesis_id})
+        anamnesis = await find_current(anamnesis_cache, find_anamnesis, db.anamnesis, anamnesis_id)
         if not anamnesis:
             raise HTTPException(status_code=404, detail="Anamnesis not found")
+        response.headers["ETag"] = version_etag(anamnesis)
         return Anamnesis(**anamnesis)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@api_router.put("/anamnesis/{anamnesis_id}", response_model=Anamnesis)
-async def update_anamnesis(anamnesis_id: str, anamnesis_update: AnamnesisCreate):
+@api_router.get("/anamnesis/{anamnesis_id}/signature")
+async def get_anamnesis_signature(anamnesis_id: str, request: Request):
+    """Serve the signature image of an anamnesis, revalidated through its ETag"""
     try:
-        anamnesis_dict = anamnesis_update.dict()
-        anamnesis_dict["updated_at"] = datetime.utcnow()
-        
-        result = await db.anamnesis.update_one(
+        anamnesis = await db.anamnesis.find_one(
             {"id": anamnesis_id},
-            {"$set": anamnesis_dict}
+            {"responsibility_term.signature_id": 1, "responsibility_term.signature": 1}
         )
-        
-        if result.matched_count == 0:
+        if not anamnesis:
             raise HTTPException(status_code=404, detail="Anamnesis not found")
-        
-        updated_anamnesis = await db.anamnesis.find_one({"id": anamnesis_id})
-        return Anamnesis(**updated_anamnesis)
+
+        term = anamnesis.get("responsibility_term", {})
+        if term.get("signature_id"):
+            signature_id = term["signature_id"]
+            data = None
+        elif term.get("signature"):
+            # Documents not migrated yet still carry the inline data URL
+            data, content_type = decode_data_url(term["signature"])
+            signature_id = blob_id_for(data)
+        else:
+            raise HTTPException(status_code=404, detail="Signature not found")
+
+        etag = f'"{signature_id}"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+        if data is None:
+            data, content_type = await blob_store.get(signature_id)
+        return Response(content=data, media_type=content_type, headers=headers)
+    except HTTPException:
+        raise
+    except BlobNotFound:
+        raise HTTPException(status_code=404, detail="Signature not found")
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-async def create_automatic_notifications(appointment_data: dict, patient_data: dict):
-    """Create automatic notifications for an appointment"""
+@api_router.put("/anamnesis/{anamnesis_id}", response_model=Anamnesis)
+async def update_anamnesis(
+    anamnesis_id: str,
+    anamnesis_update: AnamnesisCreate,
+    response: Response,
+    if_match: Optional[str] = Header(None)
+):
+    """Replace an anamnesis form; with If-Match, only if the version still matches"""
     try:
-        appointment_datetime = datetime.strptime(f"{appointment_data['date']} {appointment_data['time']}", "%Y-%m-%d %H:%M")
-        
-        # Create 1 day before notification
-        one_day_before = appointment_datetime - timedelta(days=1)
-        one_day_message = generate_whatsapp_message(
-            patient_data['name'], 
-            appointment_data['date'], 
-            appointment_data['time'], 
-            "1_day_before"
-        )
+        anamnesis_dict = anamnesis_update.dict(exclude=SIGNATURE_ID)
+        if anamnesis_dict["responsibility_term"]["signature"]:
+            await check_updatable(db.anamnesis, anamnesis_id, if_match, "Anamnesis not found")
+        term = await store_signature(anamnesis_dict.pop("responsibility_term"))
+        keep_signature = "signature_id" not in term
+        for key, value in term.items():
+            # Clients that never loaded the signature must not erase the stored one
+            if keep_signature and key in ("signature", "signature_id"):
+                continue
+            anamnesis_dict[f"responsibility_term.{key}"] = value
+        anamnesis_dict["updated_at"] = datetime.utcnow()
         
-        notification_1_day = Notification(
-            appointment_id=appointment_data['id'],
-            patient_id=appointment_data['patient_id'],
-            patient_name=patient_data['name'],
-            patient_contact=patient_data['contact'],
-            notification_type="1_day_before",
-            scheduled_time=one_day_before,
-            appointment_date=appointment_data['date'],
-            appointment_time=appointment_data['time'],
-            message=one_day_message
+        updated_anamnesis = await db.anamnesis.find_one_and_update(
+            {"id": anamnesis_id, **version_filter(if_match)},
+            {"$set": anamnesis_dict, "$inc": {"version": 1}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
         )
         
-        # Create 1 hour 30 minutes before notification
-        one_hour_30_before = appointment_datetime - timedelta(hours=1, minutes=30)
-        one_hour_30_message = generate_whatsapp_message(
-            patient_data['name'], 
-            appointment_data['date'], 
-            appointment_data['time'], 
-            "1_hour_30_before"
-        )
+        if updated_anamnesis is None:
+            await raise_not_found_or_conflict(db.anamnesis, anamnesis_id, "Anamnesis not found")
+        await anamnesis_cache.invalidate(anamnesis_id)
         
-        notification_1h30 = Notification(
+        response.headers["ETag"] = version_etag(updated_anamnesis)
+        return Anamnesis(**updated_anamnesis)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def build_automatic_notifications(appointment_data: dict, patient_data: dict) -> List[dict]:
+    """Build the reminder notifications for an appointment"""
+    appointment_datetime = appointment_data['starts_at']
+    
+    notifications = []
+    for notification_type, delta in (
+        ("1_day_before", timedelta(days=1)),
+        ("1_hour_30_before", timedelta(hours=1, minutes=30)),
+    ):
+        notification = Notification(
             appointment_id=appointment_data['id'],
             patient_id=appointment_data['patient_id'],
             patient_name=patient_data['name'],
             patient_contact=patient_data['contact'],
-            notification_type="1_hour_30_before",
-            scheduled_time=one_hour_30_before,
+            notification_type=notification_type,
+            scheduled_time=appointment_datetime - delta,
             appointment_date=appointment_data['date'],
             appointment_time=appointment_data['time'],
-            message=one_hour_30_message
+            template_version=CURRENT_TEMPLATE_VERSION
         )
-        
-        # Save notifications to database
-        await db.notifications.insert_one(notification_1_day.dict())
-        await db.notifications.insert_one(notification_1h30.dict())
-        
+        notifications.append(notification.dict(exclude={"message"}))
+    
+    return notifications
+
+# Whether the deployment is a replica set or sharded cluster, detected on first use
+transactions_supported: Optional[bool] = None
+
+async def supports_transactions() -> bool:
+    global transactions_supported
+    if transactions_supported is None:
+        hello = await client.admin.command("hello")
+        transactions_supported = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+    return transactions_supported
+
+class SlotConflictError(Exception):
+    """Raised when a booking overlaps an existing appointment"""
+
+def is_duplicate_key_error(error: Exception) -> bool:
+    if isinstance(error, DuplicateKeyError):
         return True
+    if isinstance(error, BulkWriteError):
+        return any(write_error.get("code") == 11000 for write_error in error.details.get("writeErrors", []))
+    return False
+
+async def write_appointments(appointment_docs: List[dict], notification_docs: List[dict]):
+    """Insert appointments together with their notifications, all or nothing"""
+    try:
+        if await supports_transactions():
+            async def insert_all(session):
+                await db.appointments.insert_many(appointment_docs, session=session)
+                if notification_docs:
+                    await db.notifications.insert_many(notification_docs, session=session)
+
+            async with await client.start_session() as session:
+                await session.with_transaction(insert_all)
+            return
+
+        # Standalone server: undo whatever was written if any insert fails
+        appointment_ids = [appointment["id"] for appointment in appointment_docs]
+        try:
+            await db.appointments.insert_many(appointment_docs)
+            if notification_docs:
+                await db.notifications.insert_many(notification_docs)
+        except Exception:
+            await db.notifications.delete_many({"appointment_id": {"$in": appointment_ids}})
+            await db.appointments.delete_many({"id": {"$in": appointment_ids}})
+            raise
     except Exception as e:
-        print(f"Error creating notifications: {e}")
-        return False
+        if is_duplicate_key_error(e):
+            raise SlotConflictError("Time slot already booked")
+        raise
+
+async def run_transaction(callback):
+    """Run callback(session) in a transaction where supported, otherwise callback(None)"""
+    if await supports_transactions():
+        async with await client.start_session() as session:
+            return await session.with_transaction(callback)
+    return await callback(None)
+
+async def replace_appointment_notifications(appointment_id: str, notification_docs: List[dict], session=None):
+    """Void an appointment's unsent notifications and write their replacements in one bulk_write"""
+    operations = [DeleteMany({"appointment_id": appointment_id, "sent": False})]
+    operations += [InsertOne(notification) for notification in notification_docs]
+    await db.notifications.bulk_write(operations, session=session)
+
+def notifications_booked(notification_docs: List[dict]):
+    """Let the background consumers that plan around scheduled_time know about new notifications"""
+    if not notification_docs:
+        return
+    if dispatcher:
+        dispatcher.wake()
+    broker.booked(notification_docs)
+
+def appointment_document(appointment: Appointment) -> dict:
+    """The stored form of an appointment"""
+    appointment_doc = appointment.dict()
+    if appointment.starts_at:
+        # The unique slot_keys index rejects overlapping bookings atomically
+        appointment_doc["slot_keys"] = slot_keys(appointment.starts_at, appointment.duration_minutes)
+    return appointment_doc
 
 # Appointment endpoints
 @api_router.post("/appointments", response_model=Appointment)
 async def create_appointment(appointment: AppointmentCreate):
     try:
         appointment_dict = appointment.dict()
+        try:
+            appointment_dict["starts_at"] = parse_appointment_datetime(appointment.date, appointment.time)
+        except ValueError:
+            # Without starts_at it would be missing from range queries and from the slot check
+            raise HTTPException(status_code=400, detail="Invalid date or time; use YYYY-MM-DD and HH:MM")
         appointment_obj = Appointment(**appointment_dict)
-        await db.appointments.insert_one(appointment_obj.dict())
+        appointment_doc = appointment_document(appointment_obj)
         
         # Get patient data for notifications
-        patient = await db.patients.find_one({"id": appointment.patient_id})
+        patient = await find_patient(appointment.patient_id)
+        notification_docs = []
         if patient:
-            # Create automatic notifications
-            await create_automatic_notifications(appointment_obj.dict(), patient)
+            notification_docs = build_automatic_notifications(appointment_obj.dict(), patient)
+        
+        await write_appointments([appointment_doc], notification_docs)
+        notifications_booked(notification_docs)
+        
+        return appointment_obj
+    except HTTPException:
+        raise
+    except SlotConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.post("/appointments/series", response_model=AppointmentSeries)
+async def create_appointment_series(series: AppointmentSeriesCreate):
+    """Book every occurrence of a recurring appointment in one request"""
+    try:
+        first = parse_appointment_datetime(series.date, series.time)
+        series_id = str(uuid.uuid4())
+        appointments = [
+            Appointment(
+                patient_id=series.patient_id,
+                patient_name=series.patient_name,
+                date=starts_at.strftime("%Y-%m-%d"),
+                time=starts_at.strftime("%H:%M"),
+                starts_at=starts_at,
+                duration_minutes=series.duration_minutes,
+                series_id=series_id
+            )
+            for starts_at in expand_recurrence(first, series.recurrence)
+        ]
+        appointment_docs = [appointment_document(appointment) for appointment in appointments]
+        
+        # One query checks every occurrence for conflicts
+        conflicts = await db.appointments.find(
+            {"slot_keys": {"$in": [key for doc in appointment_docs for key in doc["slot_keys"]]}},
+            {"_id": 0, "date": 1, "time": 1}
+        ).sort("starts_at", ASCENDING).to_list(None)
+        if conflicts:
+            raise HTTPException(status_code=409, detail={
+                "message": "Time slot already booked",
+                "conflicts": [f"{conflict['date']} {conflict['time']}" for conflict in conflicts]
+            })
+        
+        patient = await find_patient(series.patient_id)
+        notification_docs = []
+        if patient:
+            for appointment in appointments:
+                notification_docs.extend(build_automatic_notifications(appointment.dict(), patient))
+        
+        await write_appointments(appointment_docs, notification_docs)
+        notifications_booked(notification_docs)
+        
+        return AppointmentSeries(series_id=series_id, appointments=appointments)
+    except HTTPException:
+        raise
+    except SlotConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.patch("/appointments/{appointment_id}", response_model=Appointment)
+async def update_appointment(appointment_id: str, appointment_update: AppointmentUpdate):
+    """Reschedule or change the status of an appointment, keeping its reminders in step"""
+    try:
+        if appointment_update.status == "cancelled":
+            if appointment_update.dict(exclude_none=True).keys() - {"status"}:
+                raise HTTPException(status_code=400, detail="Cancel an appointment without changing its other fields")
+            return await cancel_appointment(appointment_id)
+        
+        current = await db.appointments.find_one({"id": appointment_id}, {"_id": 0, "slot_keys": 0})
+        if not current:
+            raise HTTPException(status_code=404, detail="Appointment not found")
+        
+        changes = appointment_update.dict(exclude_none=True)
+        appointment_obj = Appointment(**{**current, **changes})
+        notification_docs = None
+        reactivated = current.get("status") == "cancelled" and "status" in changes
+        if reactivated or {"date", "time", "duration_minutes"} & changes.keys():
+            appointment_obj.starts_at = parse_appointment_datetime(appointment_obj.date, appointment_obj.time)
+            changes["starts_at"] = appointment_obj.starts_at
+            notification_docs = []
+            if appointment_obj.status != "cancelled":
+                changes["slot_keys"] = slot_keys(appointment_obj.starts_at, appointment_obj.duration_minutes)
+                patient = await find_patient(appointment_obj.patient_id)
+                if patient:
+                    notification_docs = build_automatic_notifications(appointment_obj.dict(), patient)
+        
+        async def apply(session):
+            await db.appointments.update_one({"id": appointment_id}, {"$set": changes}, session=session)
+            if notification_docs is not None:
+                await replace_appointment_notifications(appointment_id, notification_docs, session)
+        
+        await run_transaction(apply)
+        if notification_docs:
+            notifications_booked(notification_docs)
         
         return appointment_obj
+    except HTTPException:
+        raise
+    except Exception as e:
+        if is_duplicate_key_error(e):
+            raise HTTPException(status_code=409, detail="Time slot already booked")
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.post("/appointments/{appointment_id}/cancel", response_model=Appointment)
+async def cancel_appointment(appointment_id: str):
+    """Cancel an appointment, free its slot and void its unsent reminders"""
+    try:
+        async def apply(session):
+            appointment = await db.appointments.find_one_and_update(
+                {"id": appointment_id},
+                {"$set": {"status": "cancelled"}, "$unset": {"slot_keys": ""}},
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            if appointment:
+                await replace_appointment_notifications(appointment_id, [], session)
+            return appointment
+        
+        appointment = await run_transaction(apply)
+        if not appointment:
+            raise HTTPException(status_code=404, detail="Appointment not found")
+        return Appointment(**appointment)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.delete("/appointments/{appointment_id}")
+async def delete_appointment(appointment_id: str):
+    try:
+        result = await db.appointments.delete_one({"id": appointment_id})
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Appointment not found")
+        await replace_appointment_notifications(appointment_id, [])
+        return {"message": "Appointment deleted successfully"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.post("/availability", response_model=List[AvailableSlot])
+async def get_availability(query: AvailabilityQuery):
+    """Free slots between from and to, given working hours, slot length and blocked periods"""
+    try:
+        range_start = query.from_.replace(tzinfo=None)
+        range_end = query.to.replace(tzinfo=None)
+        if range_end <= range_start or range_end - range_start > timedelta(days=MAX_AVAILABILITY_DAYS):
+            raise HTTPException(
+                status_code=400,
+                detail=f"'to' must be after 'from' and at most {MAX_AVAILABILITY_DAYS} days later"
+            )
+
+        # One query for every appointment that can overlap the range
+        appointments = await db.appointments.find(
+            {
+                "starts_at": {"$gte": range_start - timedelta(minutes=MAX_APPOINTMENT_MINUTES), "$lt": range_end},
+                "status": {"$ne": "cancelled"}
+            },
+            {"_id": 0, "starts_at": 1, "duration_minutes": 1}
+        ).to_list(None)
+
+        busy = [
+            (
+                appointment["starts_at"],
+                appointment["starts_at"] + timedelta(minutes=appointment.get("duration_minutes", DEFAULT_APPOINTMENT_MINUTES))
+            )
+            for appointment in appointments
+        ]
+        busy += [
+            (period.starts_at.replace(tzinfo=None), period.ends_at.replace(tzinfo=None))
+            for period in query.blocked_periods
+        ]
+
+        working_hours: Dict[int, list] = {}
+        for period in query.working_hours:
+            working_hours.setdefault(period.weekday, []).append((
+                datetime.strptime(period.start, "%H:%M").time(),
+                datetime.strptime(period.end, "%H:%M").time()
+            ))
+
+        slots = free_slots(range_start, range_end, working_hours, query.slot_minutes, busy)
+        return [AvailableSlot(starts_at=start, ends_at=end) for start, end in slots]
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @api_router.get("/appointments", response_model=List[Appointment])
-async def get_appointments():
+async def get_appointments(
+    from_: Optional[datetime] = Query(None, alias="from"),
+    to: Optional[datetime] = None,
+    status: Optional[str] = None
+):
+    """List appointments ordered by start time, optionally within [from, to) and by status"""
     try:
-        appointments = await db.appointments.find().to_list(1000)
-        return [Appointment(**appointment) for appointment in appointments]
+        query: Dict[str, Any] = {}
+        if from_ or to:
+            query["starts_at"] = {}
+            if from_:
+                query["starts_at"]["$gte"] = from_
+            if to:
+                query["starts_at"]["$lt"] = to
+        if status:
+            query["status"] = status
+
+        appointments = await db.appointments.find(query).sort("starts_at", ASCENDING).to_list(1000)
+        return model_list_response(Appointment, appointments)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -415,48 +1424,146 @@ async def get_appointments():
 async def get_patient_appointments(patient_id: str):
     try:
         appointments = await db.appointments.find({"patient_id": patient_id}).to_list(1000)
-        return [Appointment(**appointment) for appointment in appointments]
+        return model_list_response(Appointment, appointments)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # Notification endpoints
 @api_router.get("/notifications", response_model=List[Notification])
-async def get_notifications():
+async def get_notifications(archived: bool = False):
     try:
-        notifications = await db.notifications.find().to_list(1000)
-        return [Notification(**notification) for notification in notifications]
+        collection = db.notifications_archive if archived else db.notifications
+        notifications = await collection.find().to_list(1000)
+        for notification in notifications:
+            notification["message"] = notification_message(notification)
+        return model_list_response(Notification, notifications)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+def unsent_notifications_query(scheduled_from: Optional[datetime], scheduled_to: datetime) -> dict:
+    """Unsent notifications scheduled in [scheduled_from, scheduled_to], served by the partial queue index"""
+    scheduled_time = {"$lte": scheduled_to}
+    if scheduled_from:
+        scheduled_time["$gte"] = scheduled_from
+    return {"sent": False, "scheduled_time": scheduled_time}
+
+def notification_row(notification: dict) -> dict:
+    return {
+        "id": notification["id"],
+        "patient_name": notification["patient_name"],
+        "patient_contact": notification["patient_contact"],
+        "notification_type": notification["notification_type"],
+        "appointment_date": notification["appointment_date"],
+        "appointment_time": notification["appointment_time"],
+        "message": notification_message(notification),
+        "whatsapp_link": notification_whatsapp_link(notification),
+        "scheduled_time": notification["scheduled_time"]
+    }
+
 @api_router.get("/notifications/pending")
-async def get_pending_notifications():
+async def get_pending_notifications(
+    response: Response,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None
+):
+    """Due, unsent notifications ordered by (scheduled_time, id), paged through X-Next-Cursor"""
     try:
         current_time = datetime.utcnow()
         
         # Get notifications that are due (scheduled time is past) and not sent yet
-        pending_notifications = await db.notifications.find({
-            "scheduled_time": {"$lte": current_time},
-            "sent": False
-        }).to_list(100)
+        pending_notifications = await keyset_page(
+            db.notifications,
+            unsent_notifications_query(None, current_time),
+            "scheduled_time",
+            limit,
+            cursor,
+            response
+        )
         
-        result = []
-        for notification in pending_notifications:
-            notification_obj = Notification(**notification)
-            whatsapp_link = create_whatsapp_link(notification_obj.patient_contact, notification_obj.message)
-            
-            result.append({
-                "id": notification_obj.id,
-                "patient_name": notification_obj.patient_name,
-                "patient_contact": notification_obj.patient_contact,
-                "notification_type": notification_obj.notification_type,
-                "appointment_date": notification_obj.appointment_date,
-                "appointment_time": notification_obj.appointment_time,
-                "message": notification_obj.message,
-                "whatsapp_link": whatsapp_link,
-                "scheduled_time": notification_obj.scheduled_time
-            })
+        return [notification_row(notification) for notification in pending_notifications]
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def notification_event(notification: dict) -> str:
+    """Format a notification as a Server-Sent Event whose id is its (scheduled_time, id) cursor"""
+    event_id = encode_cursor(notification["scheduled_time"], notification["id"])
+    data = json.dumps(jsonable_encoder(notification_row(notification)))
+    return f"id: {event_id}\nevent: notification\ndata: {data}\n\n"
+
+@api_router.get("/notifications/stream")
+async def stream_notifications(request: Request, last_event_id: Optional[str] = None):
+    """Server-Sent Events stream of notifications as they become due.
+
+    Reconnecting clients send Last-Event-ID (or ?last_event_id=) and first
+    receive every due, unsent notification they missed.
+    """
+    resume_from = request.headers.get("last-event-id") or last_event_id
+    try:
+        resume_filter = keyset_filter(resume_from, "scheduled_time")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def events():
+        # Subscribe before replaying so nothing published meanwhile is lost
+        queue = broker.subscribe()
+        try:
+            yield f"retry: {STREAM_KEEPALIVE_SECONDS * 1000}\n\n"
+            if resume_from:
+                missed = await db.notifications.find(
+                    {**unsent_notifications_query(None, datetime.utcnow()), **resume_filter}
+                ).sort([("scheduled_time", ASCENDING), ("id", ASCENDING)]).to_list(STREAM_REPLAY_LIMIT)
+                for notification in missed:
+                    yield notification_event(notification)
+            while True:
+                try:
+                    notification = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                if notification is None:
+                    return
+                yield notification_event(notification)
+        finally:
+            broker.unsubscribe(queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.post("/notifications/mark-sent", response_model=List[MarkSentResult])
+async def mark_notifications_sent(request: MarkSentRequest):
+    """Mark a batch of notifications as sent with one update_many; safe to retry"""
+    try:
+        ids = list(dict.fromkeys(request.ids))
         
-        return result
+        found = await db.notifications.find({"id": {"$in": ids}}, {"_id": 0, "id": 1, "sent": 1}).to_list(None)
+        unsent = [notification["id"] for notification in found if not notification.get("sent")]
+        statuses = {notification["id"]: "already_sent" for notification in found}
+        if unsent:
+            # Millisecond precision, as stored, so the stamp can be matched below
+            now = datetime.utcnow()
+            stamp = now.replace(microsecond=now.microsecond // 1000 * 1000)
+            await db.notifications.update_many(
+                {"id": {"$in": unsent}, "sent": False},
+                {"$set": {"sent": True, "sent_at": stamp}, "$unset": {"claimed_by": "", "lease_until": ""}}
+            )
+            # Only the rows this write changed are "marked"; a concurrent call may have won the rest
+            marked = await db.notifications.find(
+                {"id": {"$in": unsent}, "sent_at": stamp}, {"_id": 0, "id": 1}
+            ).to_list(None)
+            statuses.update({notification["id"]: "marked" for notification in marked})
+        
+        # Sent notifications may already have been moved to the archive
+        missing = [notification_id for notification_id in ids if notification_id not in statuses]
+        if missing:
+            archived = await db.notifications_archive.find({"id": {"$in": missing}}, {"_id": 0, "id": 1}).to_list(None)
+            statuses.update({notification["id"]: "already_sent" for notification in archived})
+        
+        return [MarkSentResult(id=notification_id, status=statuses.get(notification_id, "not_found")) for notification_id in ids]
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -465,79 +1572,214 @@ async def mark_notification_sent(notification_id: str):
     try:
         result = await db.notifications.update_one(
             {"id": notification_id},
-            {"$set": {"sent": True}}
+            {"$set": {"sent": True, "sent_at": datetime.utcnow()}, "$unset": {"claimed_by": "", "lease_until": ""}}
         )
         
-        if result.matched_count == 0:
+        # A retry may find it already sent and moved to the archive
+        if result.matched_count == 0 and not await db.notifications_archive.find_one({"id": notification_id}, {"_id": 1}):
             raise HTTPException(status_code=404, detail="Notification not found")
         
         return {"message": "Notification marked as sent"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @api_router.get("/notifications/upcoming")
-async def get_upcoming_notifications():
+async def get_upcoming_notifications(
+    response: Response,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None
+):
+    """Unsent notifications due in the next 24 hours, paged like /notifications/pending"""
     try:
         current_time = datetime.utcnow()
         next_24_hours = current_time + timedelta(hours=24)
         
         # Get notifications scheduled for the next 24 hours
-        upcoming_notifications = await db.notifications.find({
-            "scheduled_time": {
-                "$gte": current_time,
-                "$lte": next_24_hours
-            },
-            "sent": False
-        }).to_list(100)
+        upcoming_notifications = await keyset_page(
+            db.notifications,
+            unsent_notifications_query(current_time, next_24_hours),
+            "scheduled_time",
+            limit,
+            cursor,
+            response
+        )
         
         result = []
         for notification in upcoming_notifications:
-            notification_obj = Notification(**notification)
-            whatsapp_link = create_whatsapp_link(notification_obj.patient_contact, notification_obj.message)
-            
-            result.append({
-                "id": notification_obj.id,
-                "patient_name": notification_obj.patient_name,
-                "patient_contact": notification_obj.patient_contact,
-                "notification_type": notification_obj.notification_type,
-                "appointment_date": notification_obj.appointment_date,
-                "appointment_time": notification_obj.appointment_time,
-                "message": notification_obj.message,
-                "whatsapp_link": whatsapp_link,
-                "scheduled_time": notification_obj.scheduled_time,
-                "time_until_send": notification_obj.scheduled_time - current_time
-            })
+            row = notification_row(notification)
+            row["time_until_send"] = notification["scheduled_time"] - current_time
+            result.append(row)
         
         return result
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-@api_router.get("/search/patients")
-async def search_patients(q: str):
-    try:
-        # Search by name, CPF, or contact
-        patients = await db.patients.find({
-            "$or": [
-                {"name": {"$regex": q, "$options": "i"}},
-                {"contact": {"$regex": q, "$options": "i"}},
-                {"cpf": {"$regex": q, "$options": "i"}}
-            ]
-        }).to_list(100)
-        
-        return [Patient(**patient) for patient in patients]
+
+# Matches ranked per search; more than the largest page so ranking has a choice
+SEARCH_CANDIDATES = 200
+
+@api_router.get("/search/patients", response_model=List[Patient])
+async def search_patients(q: str, limit: int = Query(20, ge=1, le=100)):
+    """Search patients by name, phone or CPF prefix, ignoring case and accents"""
+    try:
+        tokens = name_tokens(q)
+        digits = only_digits(q)
+
+        # Candidates are fetched best tier first, so exact matches are never
+        # crowded out of the cap by a common prefix such as "ma" or "sil"
+        tiers = [[], [], []]
+        if any(not token.isdigit() for token in tokens):
+            prefixes = [{"search_name": {"$regex": f"^{re.escape(token)}"}} for token in tokens]
+            tiers[0].append({"$and": [{"search_name": token} for token in tokens]})
+            tiers[1].append({"$and": prefixes + [{"search_name": {"$in": tokens}}]})
+            tiers[2].append({"$and": prefixes})
+        if digits:
+            tiers[0].extend([{"search_phone": digits}, {"search_cpf": digits}])
+            prefix = {"$regex": f"^{digits}"}
+            tiers[2].extend([{"search_phone": prefix}, {"search_cpf": prefix}])
+        if not tiers[0]:
+            return []
+
+        patients = []
+        for clauses in tiers:
+            if len(patients) >= SEARCH_CANDIDATES:
+                break
+            if not clauses:
+                continue
+            query = {"$or": clauses}
+            if patients:
+                query["id"] = {"$nin": [patient["id"] for patient in patients]}
+            remaining = SEARCH_CANDIDATES - len(patients)
+            patients.extend(await db.patients.find(query).limit(remaining).to_list(remaining))
+
+        patients.sort(key=lambda patient: rank_search_result(patient, tokens, digits))
+        return model_list_response(Patient, patients[:limit])
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+# Export endpoints
+EXPORT_BATCH_SIZE = 1000
+
+def export_columns(model, prefix: str = "") -> List[str]:
+    """CSV columns of a model, with nested models flattened into dotted columns"""
+    columns = []
+    for name, info in model.model_fields.items():
+        annotation = info.annotation
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            columns.extend(export_columns(annotation, f"{prefix}{name}."))
+        else:
+            columns.append(f"{prefix}{name}")
+    return columns
+
+# collection -> (model, projection); inline signatures and internal keys are left out
+EXPORTS = {
+    "patients": (Patient, {"_id": 0, "search_name": 0, "search_phone": 0, "search_cpf": 0, "dedupe_keys": 0}),
+    "anamnesis": (Anamnesis, {"_id": 0, "responsibility_term.signature": 0}),
+    "appointments": (Appointment, {"_id": 0, "slot_keys": 0}),
+}
+
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def csv_value(document: dict, column: str) -> Any:
+    value = document
+    for key in column.split("."):
+        if not isinstance(value, dict):
+            return ""
+        value = value.get(key, "")
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return orjson.dumps(value).decode()
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        # Spreadsheets would run it as a formula; a leading ' makes it plain text
+        return f"'{value}"
+    return value
+
+async def ndjson_rows(cursor):
+    """Encode a cursor as NDJSON, one chunk per batch"""
+    try:
+        chunk: List[bytes] = []
+        async for document in cursor:
+            chunk.append(orjson.dumps(document) + b"\n")
+            if len(chunk) >= EXPORT_BATCH_SIZE:
+                yield b"".join(chunk)
+                chunk.clear()
+        if chunk:
+            yield b"".join(chunk)
+    finally:
+        await cursor.close()
+
+async def csv_rows(cursor, columns: List[str]):
+    """Encode a cursor as CSV with a header row, one chunk per batch"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    rows = 0
+    try:
+        async for document in cursor:
+            writer.writerow([csv_value(document, column) for column in columns])
+            rows += 1
+            if rows % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode()
+    finally:
+        await cursor.close()
+
+@api_router.get("/export/{collection}")
+async def export_collection(collection: str, format: str = Query("ndjson", pattern="^(ndjson|csv)$")):
+    """Stream a whole collection as NDJSON or CSV, in constant memory.
+
+    Documents are read from a cursor EXPORT_BATCH_SIZE at a time and written
+    out as they arrive; in CSV, nested anamnesis sections become dotted columns.
+    """
+    if collection not in EXPORTS:
+        raise HTTPException(status_code=404, detail=f"Unknown export: {collection}")
+    model, projection = EXPORTS[collection]
+    cursor = db[collection].find({}, projection).batch_size(EXPORT_BATCH_SIZE)
+    
+    filename = f"{collection}-{datetime.utcnow():%Y%m%d}.{format}"
+    if format == "csv":
+        return StreamingResponse(
+            csv_rows(cursor, [column for column in export_columns(model) if projection.get(column) != 0]),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+    return StreamingResponse(
+        ndjson_rows(cursor),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# Admin endpoints
+@api_router.get("/admin/slow-queries")
+async def get_slow_queries(limit: int = Query(50, ge=1, le=200)):
+    """Recent queries slower than SLOW_QUERY_MS, newest first, with values redacted"""
+    return slow_query_log.recent(limit)
+
 # Include the router in the main app
 app.include_router(api_router)
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Request and MongoDB command metrics in the Prometheus text format"""
+    return metrics_response()
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
+app.add_middleware(MetricsMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -545,6 +1787,143 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Declared MongoDB indexes, provisioned at startup
+INDEXES = {
+    "patients": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("search_name", ASCENDING)]),
+        IndexModel([("search_phone", ASCENDING)]),
+        IndexModel([("search_cpf", ASCENDING)]),
+        IndexModel([("dedupe_keys", ASCENDING)]),
+    ],
+    "anamnesis": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("patient_id", ASCENDING)]),
+    ],
+    "appointments": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("patient_id", ASCENDING)]),
+        IndexModel([("starts_at", ASCENDING), ("status", ASCENDING)]),
+        IndexModel(
+            [("slot_keys", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"slot_keys": {"$exists": True}}
+        ),
+    ],
+    "notifications": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("appointment_id", ASCENDING)]),
+        # Queue of unsent notifications; sent ones are left out of the index entirely
+        IndexModel(
+            [("scheduled_time", ASCENDING), ("id", ASCENDING)],
+            partialFilterExpression={"sent": False}
+        ),
+        # Recently booked unsent notifications, read by the stream broker's late-arrival scan
+        IndexModel([("created_at", ASCENDING)], partialFilterExpression={"sent": False}),
+        # Sent notifications waiting to be archived
+        IndexModel([("sent", ASCENDING)], partialFilterExpression={"sent": True}),
+    ],
+    "notifications_archive": [
+        IndexModel([("id", ASCENDING)]),
+        IndexModel([("archived_at", ASCENDING)], expireAfterSeconds=NOTIFICATION_ARCHIVE_RETENTION_DAYS * 86400),
+    ],
+}
+
+# Index options that must match the declaration for an index to count as built correctly
+INDEX_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+def index_differences(declared: dict, existing: dict) -> Dict[str, Tuple[Any, Any]]:
+    """Map each part of an existing index that differs from its declaration to (existing, declared)"""
+    differences = {}
+    declared_key = [(field, int(direction)) for field, direction in declared["key"].items()]
+    existing_key = [(field, int(direction)) for field, direction in existing["key"].items()]
+    if declared_key != existing_key:
+        differences["key"] = (existing_key, declared_key)
+    for option in INDEX_OPTIONS:
+        if existing.get(option) != declared.get(option):
+            differences[option] = (existing.get(option), declared.get(option))
+    return differences
+
+async def ensure_indexes():
+    """Create missing declared indexes and log any that were built differently"""
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        existing = {index["name"]: index async for index in collection.list_indexes()}
+
+        for model in models:
+            declared = model.document
+            current = existing.get(declared["name"])
+            if current is None:
+                logger.warning(f"Index {collection_name}.{declared['name']} is missing, creating it")
+                # One at a time, so a failing build doesn't hide which of the others were created
+                try:
+                    await collection.create_indexes([model])
+                except OperationFailure as e:
+                    logger.error(f"Failed to create index {collection_name}.{declared['name']}: {e}")
+                continue
+            differences = index_differences(declared, current)
+            if list(differences) == ["expireAfterSeconds"] and declared.get("expireAfterSeconds") is not None:
+                # A changed retention period can be applied in place
+                logger.info(f"Updating TTL of index {collection_name}.{declared['name']}")
+                await db.command(
+                    "collMod", collection_name,
+                    index={"name": declared["name"], "expireAfterSeconds": declared["expireAfterSeconds"]}
+                )
+            elif differences:
+                logger.warning(
+                    f"Index {collection_name}.{declared['name']} differs from declaration: "
+                    + "; ".join(f"{part} {existing!r} != {wanted!r}" for part, (existing, wanted) in differences.items())
+                )
+
+        declared_names = {model.document["name"] for model in models}
+        for name in existing.keys() - declared_names - {"_id_"}:
+            logger.warning(f"Index {collection_name}.{name} is not declared and can be dropped")
+
+async def backfill_search_keys(batch_size: int = 500):
+    """Compute search keys for patients written before they existed"""
+    updated = 0
+    cursor = db.patients.find(
+        {"$or": [{"search_name": {"$exists": False}}, {"dedupe_keys": {"$exists": False}}]},
+        {"_id": 1, "name": 1, "birth_date": 1, "contact": 1, "cpf": 1}
+    ).batch_size(batch_size)
+    batch = []
+    async for patient in cursor:
+        batch.append(UpdateOne({"_id": patient["_id"]}, {"$set": patient_search_keys(patient)}))
+        if len(batch) >= batch_size:
+            updated += (await db.patients.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        updated += (await db.patients.bulk_write(batch, ordered=False)).modified_count
+    if updated:
+        logger.info(f"Backfilled search keys for {updated} patients")
+
+@app.on_event("startup")
+async def prepare_database():
+    try:
+        await ensure_indexes()
+        await backfill_search_keys()
+    except Exception as e:
+        logger.error(f"Database preparation failed: {e}")
+
+    if dispatcher:
+        dispatcher.start()
+    archiver.start()
+    broker.start()
+    slow_query_log.start(client)
+    if cache_channel:
+        try:
+            await cache_channel.start()
+        except Exception as e:
+            logger.error(f"Cache invalidation channel failed to start: {e}")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if dispatcher:
+        await dispatcher.stop()
+    await archiver.stop()
+    await broker.stop()
+    await slow_query_log.stop()
+    if cache_channel:
+        await cache_channel.stop()
     client.close()
\ No newline at end of file
@@ -0,0 +1,190 @@
+"""Slow query log with sampled explain capture.
+
+SlowQueryLog is a pymongo CommandListener. Commands slower than the threshold
+are logged and kept in a ring buffer with their filter shape: field names and
+operators are kept, every value is replaced by "?", because filters carry
+patient data. A sample of slow reads is re-run as explain("executionStats") by
+a background task, off the request path, and the winning plan (stages and
+index names only, no index bounds) is attached to the entry, so a COLLSCAN
+shows up next to the query that caused it.
+
+Listener callbacks run on Motor's executor threads; they only append to the
+buffer and hand explain work to the event loop.
+"""
+import asyncio
+import logging
+import random
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Read commands that can be explained, and where each keeps its filter
+FILTER_FIELDS = {"find": "filter", "aggregate": "pipeline", "count": "query", "distinct": "query"}
+WRITE_FILTER_FIELDS = {"update": "updates", "delete": "deletes", "findAndModify": "query"}
+SHAPE_FIELDS = ("sort", "projection")
+# Fields that tie a command to its original session or connection; dropped before explaining
+SESSION_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"}
+
+
+def redact(value: Any) -> Any:
+    """Shape of a filter: keys and operators kept, values replaced by "?" """
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) and value and all(isinstance(item, dict) for item in value):
+        # $and/$or clauses and pipeline stages
+        return [redact(item) for item in value]
+    return "?"
+
+
+def command_shape(command_name: str, command: dict) -> Dict[str, Any]:
+    shape: Dict[str, Any] = {}
+    if command_name in FILTER_FIELDS:
+        shape["filter"] = redact(command.get(FILTER_FIELDS[command_name], {}))
+    elif command_name in ("update", "delete"):
+        statements = command.get(WRITE_FILTER_FIELDS[command_name]) or [{}]
+        shape["filter"] = redact(statements[0].get("q", {}))
+    elif command_name == "findAndModify":
+        shape["filter"] = redact(command.get("query", {}))
+    # Sort and projection only name fields and directions, so they are kept as is
+    for field in SHAPE_FIELDS:
+        if field in command:
+            shape[field] = dict(command[field])
+    return shape
+
+
+def plan_summary(plan: dict) -> dict:
+    """Stage tree of a winning plan with index names, dropping bounds and filters"""
+    plan = plan.get("queryPlan", plan)
+    summary = {"stage": plan.get("stage")}
+    if "indexName" in plan:
+        summary["index"] = plan["indexName"]
+    children = ([plan["inputStage"]] if "inputStage" in plan else []) + plan.get("inputStages", [])
+    if children:
+        summary["inputs"] = [plan_summary(child) for child in children]
+    return summary
+
+
+def plan_stages(summary: dict) -> List[str]:
+    stages = [summary["stage"]]
+    for child in summary.get("inputs", []):
+        stages.extend(plan_stages(child))
+    return stages
+
+
+class SlowQueryLog(monitoring.CommandListener):
+    def __init__(
+        self,
+        threshold_ms: float = 100,
+        explain_sample_rate: float = 0.1,
+        size: int = 200,
+        explain_queue_size: int = 20,
+    ):
+        self.threshold_ms = threshold_ms
+        self.explain_sample_rate = explain_sample_rate
+        self.entries: Deque[dict] = deque(maxlen=size)
+        self.explain_queue_size = explain_queue_size
+        self._pending: Dict[Tuple[int, object], Tuple[str, dict]] = {}
+        self._client = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, client) -> None:
+        """Start explaining sampled slow reads with client, on the running event loop"""
+        if self._task is None:
+            self._client = client
+            self._loop = asyncio.get_running_loop()
+            self._queue = asyncio.Queue(maxsize=self.explain_queue_size)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._loop = None
+
+    def recent(self, limit: int) -> List[dict]:
+        """Newest entries first"""
+        return list(reversed(list(self.entries)))[:limit]
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if event.command_name in FILTER_FIELDS or event.command_name in WRITE_FILTER_FIELDS:
+            self._pending[(event.request_id, event.connection_id)] = (event.database_name, event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finished(event, failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finished(event, failed=True)
+
+    def _finished(self, event, failed: bool) -> None:
+        pending = self._pending.pop((event.request_id, event.connection_id), None)
+        duration_ms = event.duration_micros / 1000
+        if pending is None or duration_ms < self.threshold_ms:
+            return
+
+        database, command = pending
+        collection = command.get(event.command_name)
+        entry = {
+            "at": datetime.utcnow(),
+            "database": database,
+            "collection": collection if isinstance(collection, str) else "",
+            "command": event.command_name,
+            "duration_ms": round(duration_ms, 1),
+            "failed": failed,
+            "shape": command_shape(event.command_name, command),
+            "plan": None,
+        }
+        self.entries.append(entry)
+        logger.warning(
+            f"Slow {entry['command']} on {entry['collection']} took {entry['duration_ms']} ms: {entry['shape']}"
+        )
+
+        if event.command_name in FILTER_FIELDS and self._loop is not None and random.random() < self.explain_sample_rate:
+            self._loop.call_soon_threadsafe(self._enqueue, entry, database, command)
+
+    def _enqueue(self, entry: dict, database: str, command: dict) -> None:
+        try:
+            self._queue.put_nowait((entry, database, command))
+        except asyncio.QueueFull:
+            # Explains are best effort; never let them pile up behind a slow database
+            pass
+
+    async def explain(self, entry: dict, database: str, command: dict) -> None:
+        explained = {key: value for key, value in command.items() if key not in SESSION_FIELDS and not key.startswith("$")}
+        result = await self._client[database].command(
+            {"explain": explained, "verbosity": "executionStats"}
+        )
+        if "queryPlanner" not in result and result.get("stages"):
+            # Aggregations report the plan of their initial $cursor stage
+            result = result["stages"][0].get("$cursor", {})
+        plan = plan_summary(result.get("queryPlanner", {}).get("winningPlan", {}))
+        stats = result.get("executionStats", {})
+        entry["plan"] = {
+            "winning_plan": plan,
+            "collscan": "COLLSCAN" in plan_stages(plan),
+            "n_returned": stats.get("nReturned"),
+            "keys_examined": stats.get("totalKeysExamined"),
+            "docs_examined": stats.get("totalDocsExamined"),
+            "execution_ms": stats.get("executionTimeMillis"),
+        }
+        if entry["plan"]["collscan"]:
+            logger.warning(f"Slow {entry['command']} on {entry['collection']} is a COLLSCAN: {entry['shape']}")
+
+    async def _run(self) -> None:
+        while True:
+            entry, database, command = await self._queue.get()
+            try:
+                await self.explain(entry, database, command)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Could not explain slow {entry['command']} on {entry['collection']}: {e}")
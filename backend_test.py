@@ -1,12 +1,19 @@
 import requests
+import csv
+import io
 import json
+import os
+import sys
 import time
 import unittest
+import uuid
 from datetime import datetime, timedelta
+from pathlib import Path
 
 # Get the backend URL from the frontend/.env file
 BACKEND_URL = "https://6fc52b3e-8be9-42cb-8b74-7d2ad243b2fc.preview.emergentagent.com/api"
 
+
 class PodiatryBackendTest(unittest.TestCase):
     """Test suite for the Podiatry Management System Backend API"""
     
@@ -852,6 +859,800 @@ class PodiatryBackendTest(unittest.TestCase):
         
         return patient_id, appointment_ids
 
+    def test_11_accent_insensitive_search(self):
+        """Test that search ignores accents and escapes special characters"""
+        print("\n=== Testing Accent-Insensitive Search ===")
+        
+        accented_patient = self.test_patient.copy()
+        accented_patient["name"] = f"João Acentuação{int(time.time())}"
+        accented_patient["contact"] = "(11) 97531-8642"
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=accented_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        for search_term in ["Joao Acentuacao", "JOÃO acent", "975318", "11975318642"]:
+            print(f"Searching for patients with term: {search_term}")
+            response = requests.get(f"{BACKEND_URL}/search/patients", params={"q": search_term})
+            self.assertEqual(response.status_code, 200, f"Failed to search patients: {response.text}")
+            
+            found_ids = [patient["id"] for patient in response.json()]
+            self.assertIn(patient_id, found_ids, f"Could not find patient with term {search_term}")
+        
+        # Regex metacharacters must not break the query
+        response = requests.get(f"{BACKEND_URL}/search/patients", params={"q": "(Joao"})
+        self.assertEqual(response.status_code, 200, f"Search with special characters failed: {response.text}")
+        
+        print("Accent-insensitive search successful")
+        
+        return patient_id
+
+    def test_12_signature_blob_endpoint(self):
+        """Test that signatures are stored out of line and served with an ETag"""
+        print("\n=== Testing Signature Blob Endpoint ===")
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=self.test_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        self.test_anamnesis["patient_id"] = patient_id
+        response = requests.post(f"{BACKEND_URL}/anamnesis", json=self.test_anamnesis)
+        self.assertEqual(response.status_code, 200, f"Failed to create anamnesis: {response.text}")
+        
+        anamnesis_data = response.json()
+        anamnesis_id = anamnesis_data["id"]
+        self.created_resources["anamnesis"].append(anamnesis_id)
+        
+        term = anamnesis_data["responsibility_term"]
+        self.assertEqual(term["signature"], "", "Signature should not be stored inline")
+        self.assertTrue(term["signature_id"], "Expected a signature_id")
+        
+        print(f"Getting signature for anamnesis {anamnesis_id}")
+        response = requests.get(f"{BACKEND_URL}/anamnesis/{anamnesis_id}/signature")
+        self.assertEqual(response.status_code, 200, f"Failed to get signature: {response.text}")
+        self.assertEqual(response.headers["Content-Type"], "image/png")
+        self.assertTrue(response.content.startswith(b"\x89PNG"), "Expected PNG bytes")
+        
+        etag = response.headers["ETag"]
+        response = requests.get(
+            f"{BACKEND_URL}/anamnesis/{anamnesis_id}/signature",
+            headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 304, "Expected 304 for a matching ETag")
+        
+        # A client-supplied signature_id is ignored; only uploaded signatures set it
+        update = dict(self.test_anamnesis)
+        update["responsibility_term"] = {
+            **self.test_anamnesis["responsibility_term"],
+            "signature": "",
+            "signature_id": "someone-elses-signature"
+        }
+        response = requests.put(f"{BACKEND_URL}/anamnesis/{anamnesis_id}", json=update)
+        self.assertEqual(response.status_code, 200, f"Failed to update anamnesis: {response.text}")
+        self.assertEqual(response.json()["responsibility_term"]["signature_id"], term["signature_id"])
+        
+        update["responsibility_term"]["signature"] = "data:image/png;base64,not*base64!"
+        response = requests.put(f"{BACKEND_URL}/anamnesis/{anamnesis_id}", json=update)
+        self.assertEqual(response.status_code, 400, "Expected 400 for an invalid signature image")
+        
+        print("Signature blob endpoint successful")
+        
+        return anamnesis_id
+
+    def test_13_appointment_date_range(self):
+        """Test listing appointments within a date range"""
+        print("\n=== Testing Appointment Date Range ===")
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=self.test_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        appointment_ids = []
+        for date, time_str in [("2031-03-10", "09:00"), ("2031-03-12", "15:30"), ("2031-03-20", "10:00")]:
+            appointment = {"patient_id": patient_id, "patient_name": "Maria Silva", "date": date, "time": time_str}
+            response = requests.post(f"{BACKEND_URL}/appointments", json=appointment)
+            self.assertEqual(response.status_code, 200, f"Failed to create appointment: {response.text}")
+            self.assertTrue(response.json()["starts_at"].startswith(f"{date}T{time_str}"), "starts_at not set")
+            appointment_ids.append(response.json()["id"])
+            self.created_resources["appointments"].append(response.json()["id"])
+        
+        print("Getting appointments for the week of 2031-03-10...")
+        response = requests.get(f"{BACKEND_URL}/appointments", params={"from": "2031-03-10", "to": "2031-03-17"})
+        self.assertEqual(response.status_code, 200, f"Failed to get appointments: {response.text}")
+        
+        in_range = [a for a in response.json() if a["id"] in appointment_ids]
+        self.assertEqual([a["id"] for a in in_range], appointment_ids[:2], "Expected the first two appointments, in order")
+        
+        # A booking that can't be placed on the calendar is rejected, not stored without starts_at
+        appointment = {"patient_id": patient_id, "patient_name": "Maria Silva", "date": "10/03/2031", "time": "9h"}
+        response = requests.post(f"{BACKEND_URL}/appointments", json=appointment)
+        self.assertEqual(response.status_code, 400, f"Expected 400 for an unparseable date, got: {response.status_code}")
+        
+        print("Appointment date range successful")
+        
+        return patient_id, appointment_ids
+
+    def test_14_slot_conflicts_and_availability(self):
+        """Test that overlapping bookings are rejected and availability skips booked slots"""
+        print("\n=== Testing Slot Conflicts and Availability ===")
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=self.test_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        appointment = {"patient_id": patient_id, "patient_name": "Maria Silva", "date": "2031-04-07", "time": "09:00"}
+        response = requests.post(f"{BACKEND_URL}/appointments", json=appointment)
+        self.assertEqual(response.status_code, 200, f"Failed to create appointment: {response.text}")
+        self.created_resources["appointments"].append(response.json()["id"])
+        
+        print("Booking an overlapping appointment...")
+        overlapping = dict(appointment, time="09:30")
+        response = requests.post(f"{BACKEND_URL}/appointments", json=overlapping)
+        self.assertEqual(response.status_code, 409, f"Expected 409 for overlapping booking, got: {response.status_code}")
+        
+        print("Getting availability for 2031-04-07...")
+        response = requests.post(f"{BACKEND_URL}/availability", json={
+            "from": "2031-04-07T08:00:00",
+            "to": "2031-04-07T12:00:00",
+            "slot_minutes": 60,
+            "blocked_periods": [{"starts_at": "2031-04-07T11:00:00", "ends_at": "2031-04-07T12:00:00"}]
+        })
+        self.assertEqual(response.status_code, 200, f"Failed to get availability: {response.text}")
+        
+        slot_starts = [slot["starts_at"][:16] for slot in response.json()]
+        self.assertIn("2031-04-07T08:00", slot_starts)
+        self.assertIn("2031-04-07T10:00", slot_starts)
+        self.assertNotIn("2031-04-07T09:00", slot_starts, "Booked slot reported as free")
+        self.assertNotIn("2031-04-07T11:00", slot_starts, "Blocked slot reported as free")
+        
+        print("Slot conflicts and availability successful")
+        
+        return patient_id
+
+    def test_15_bulk_mark_sent(self):
+        """Test marking several notifications as sent in one request"""
+        print("\n=== Testing Bulk Mark-Sent ===")
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=self.test_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        appointment = {"patient_id": patient_id, "patient_name": "Maria Silva", "date": "2031-05-05", "time": "11:00"}
+        response = requests.post(f"{BACKEND_URL}/appointments", json=appointment)
+        self.assertEqual(response.status_code, 200, f"Failed to create appointment: {response.text}")
+        appointment_id = response.json()["id"]
+        self.created_resources["appointments"].append(appointment_id)
+        
+        response = requests.get(f"{BACKEND_URL}/notifications")
+        notification_ids = [n["id"] for n in response.json() if n["appointment_id"] == appointment_id]
+        self.assertEqual(len(notification_ids), 2, "Expected 2 notifications for the appointment")
+        
+        request_ids = notification_ids + ["00000000-0000-0000-0000-000000000000"]
+        print("Marking notifications as sent...")
+        response = requests.post(f"{BACKEND_URL}/notifications/mark-sent", json={"ids": request_ids})
+        self.assertEqual(response.status_code, 200, f"Failed to mark notifications: {response.text}")
+        self.assertEqual([r["status"] for r in response.json()], ["marked", "marked", "not_found"])
+        
+        print("Retrying the same request...")
+        response = requests.post(f"{BACKEND_URL}/notifications/mark-sent", json={"ids": request_ids})
+        self.assertEqual(response.status_code, 200, f"Failed to retry mark-sent: {response.text}")
+        self.assertEqual([r["status"] for r in response.json()], ["already_sent", "already_sent", "not_found"])
+        
+        print("Bulk mark-sent successful")
+        
+        return patient_id, appointment_id
+
+    def test_16_reschedule_and_cancel_appointment(self):
+        """Test that rescheduling and cancelling an appointment updates its notifications"""
+        print("\n=== Testing Reschedule and Cancel Appointment ===")
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=self.test_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        appointment = {"patient_id": patient_id, "patient_name": "Maria Silva", "date": "2031-06-02", "time": "10:00"}
+        response = requests.post(f"{BACKEND_URL}/appointments", json=appointment)
+        self.assertEqual(response.status_code, 200, f"Failed to create appointment: {response.text}")
+        appointment_id = response.json()["id"]
+        self.created_resources["appointments"].append(appointment_id)
+        
+        print("Rescheduling appointment to 2031-06-03 14:00...")
+        response = requests.patch(f"{BACKEND_URL}/appointments/{appointment_id}", json={"date": "2031-06-03", "time": "14:00"})
+        self.assertEqual(response.status_code, 200, f"Failed to reschedule appointment: {response.text}")
+        self.assertEqual(response.json()["starts_at"][:16], "2031-06-03T14:00")
+        
+        response = requests.get(f"{BACKEND_URL}/notifications")
+        notifications = [n for n in response.json() if n["appointment_id"] == appointment_id]
+        self.assertEqual(len(notifications), 2, "Expected 2 notifications after rescheduling")
+        self.assertEqual(sorted(n["scheduled_time"][:16] for n in notifications), ["2031-06-02T14:00", "2031-06-03T12:30"])
+        
+        print("Booking the freed slot...")
+        response = requests.post(f"{BACKEND_URL}/appointments", json=appointment)
+        self.assertEqual(response.status_code, 200, f"Old slot was not freed: {response.text}")
+        self.created_resources["appointments"].append(response.json()["id"])
+        
+        response = requests.patch(
+            f"{BACKEND_URL}/appointments/{appointment_id}",
+            json={"status": "cancelled", "date": "2031-06-04"}
+        )
+        self.assertEqual(response.status_code, 400, "Cancelling must not silently drop other changes")
+        
+        print("Cancelling appointment...")
+        response = requests.post(f"{BACKEND_URL}/appointments/{appointment_id}/cancel")
+        self.assertEqual(response.status_code, 200, f"Failed to cancel appointment: {response.text}")
+        self.assertEqual(response.json()["status"], "cancelled")
+        
+        response = requests.get(f"{BACKEND_URL}/notifications")
+        self.assertFalse(any(n["appointment_id"] == appointment_id for n in response.json()), "Notifications survived cancellation")
+        
+        response = requests.post(f"{BACKEND_URL}/appointments/00000000-0000-0000-0000-000000000000/cancel")
+        self.assertEqual(response.status_code, 404)
+        
+        print("Reschedule and cancel successful")
+        
+        return patient_id, appointment_id
+
+    def test_17_cached_patient_reflects_updates(self):
+        """Test that a patient read after an update or delete is never served stale from the cache"""
+        print("\n=== Testing Patient Cache Invalidation ===")
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=self.test_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        print("Reading patient twice to warm the cache...")
+        for _ in range(2):
+            response = requests.get(f"{BACKEND_URL}/patients/{patient_id}")
+            self.assertEqual(response.status_code, 200, f"Failed to get patient: {response.text}")
+            self.assertEqual(response.json()["name"], self.test_patient["name"])
+        
+        print("Updating patient...")
+        updated_patient = dict(self.test_patient, name="Maria Silva Santos")
+        response = requests.put(f"{BACKEND_URL}/patients/{patient_id}", json=updated_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to update patient: {response.text}")
+        
+        response = requests.get(f"{BACKEND_URL}/patients/{patient_id}")
+        self.assertEqual(response.json()["name"], "Maria Silva Santos", "Stale patient served after update")
+        
+        print("Deleting patient...")
+        response = requests.delete(f"{BACKEND_URL}/patients/{patient_id}")
+        self.assertEqual(response.status_code, 200, f"Failed to delete patient: {response.text}")
+        self.created_resources["patients"].remove(patient_id)
+        
+        response = requests.get(f"{BACKEND_URL}/patients/{patient_id}")
+        self.assertNotEqual(response.status_code, 200, "Deleted patient still served")
+        
+        print("Patient cache invalidation successful")
+
+    def test_18_conditional_patient_update(self):
+        """Test that updates with a stale If-Match version are rejected with 412"""
+        print("\n=== Testing Conditional Patient Update ===")
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=self.test_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        response = requests.get(f"{BACKEND_URL}/patients/{patient_id}")
+        etag = response.headers.get("ETag")
+        self.assertIsNotNone(etag, "Patient response has no ETag")
+        
+        print("Updating with the current version...")
+        first_edit = dict(self.test_patient, profession="Enfermeira")
+        response = requests.put(f"{BACKEND_URL}/patients/{patient_id}", json=first_edit, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, 200, f"Failed to update patient: {response.text}")
+        self.assertNotEqual(response.headers.get("ETag"), etag, "Version not incremented")
+        self.assertEqual(response.json()["profession"], "Enfermeira")
+        
+        print("Updating with the stale version...")
+        second_edit = dict(self.test_patient, profession="Professora aposentada")
+        response = requests.put(f"{BACKEND_URL}/patients/{patient_id}", json=second_edit, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, 412, f"Expected 412 for stale version, got: {response.status_code}")
+        
+        response = requests.get(f"{BACKEND_URL}/patients/{patient_id}")
+        self.assertEqual(response.json()["profession"], "Enfermeira", "Stale update was applied")
+        
+        print("Conditional patient update successful")
+        
+        return patient_id
+
+    def test_19_anamnesis_patch_and_observations(self):
+        """Test partial anamnesis updates and appending observation entries"""
+        print("\n=== Testing Anamnesis Patch and Observations ===")
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=self.test_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        anamnesis_data = dict(self.test_anamnesis, patient_id=patient_id)
+        response = requests.post(f"{BACKEND_URL}/anamnesis", json=anamnesis_data)
+        self.assertEqual(response.status_code, 200, f"Failed to create anamnesis: {response.text}")
+        anamnesis_id = response.json()["id"]
+        self.created_resources["anamnesis"].append(anamnesis_id)
+        
+        print("Patching clinical data...")
+        response = requests.patch(
+            f"{BACKEND_URL}/anamnesis/{anamnesis_id}",
+            data=json.dumps({"clinical_data": {"diabetes": True, "diabetes_type": "Tipo 2"}}),
+            headers={"Content-Type": "application/merge-patch+json"}
+        )
+        self.assertEqual(response.status_code, 200, f"Failed to patch anamnesis: {response.text}")
+        patched = response.json()
+        self.assertTrue(patched["clinical_data"]["diabetes"])
+        self.assertEqual(patched["clinical_data"]["diabetes_type"], "Tipo 2")
+        self.assertEqual(patched["general_data"]["chief_complaint"], anamnesis_data["general_data"]["chief_complaint"])
+        
+        response = requests.patch(f"{BACKEND_URL}/anamnesis/{anamnesis_id}", json={"patient_id": "other"})
+        self.assertEqual(response.status_code, 400, "Patching patient_id should be rejected")
+        
+        print("Appending an observation...")
+        response = requests.post(
+            f"{BACKEND_URL}/anamnesis/{anamnesis_id}/observations",
+            json={"text": "Retorno em 30 dias"}
+        )
+        self.assertEqual(response.status_code, 200, f"Failed to add observation: {response.text}")
+        
+        response = requests.get(f"{BACKEND_URL}/anamnesis/form/{anamnesis_id}")
+        entries = response.json()["observation_entries"]
+        self.assertEqual([entry["text"] for entry in entries], ["Retorno em 30 dias"])
+        
+        print("Anamnesis patch and observations successful")
+        
+        return patient_id, anamnesis_id
+
+    def test_20_bulk_patient_import(self):
+        """Test importing patients from CSV with normalization, deduplication and a row report"""
+        print("\n=== Testing Bulk Patient Import ===")
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=self.test_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        existing_id = response.json()["id"]
+        self.created_resources["patients"].append(existing_id)
+        
+        suffix = uuid.uuid4().hex[:8]
+        columns = ["name", "address", "neighborhood", "city", "state", "cep", "birth_date", "sex", "profession", "contact"]
+        rows = [
+            [f"Importado {suffix}", "Rua A, 1", "Centro", "São Paulo", "SP", "01001000", "1975-03-10", "Masculino", "Pedreiro", "+55 11 98765-4321"],
+            [f"IMPORTADO {suffix}", "Rua B, 2", "Centro", "São Paulo", "SP", "01001-000", "10/03/1975", "Masculino", "Pedreiro", ""],
+            [self.test_patient["name"], "Rua C, 3", "Centro", "São Paulo", "SP", "01001-000", self.test_patient["birth_date"], "Feminino", "", ""],
+            ["", "Rua D, 4", "Centro", "São Paulo", "SP", "01001-000", "1980-01-01", "Feminino", "", ""],
+        ]
+        body = "\n".join(",".join(f'"{value}"' for value in row) for row in [columns] + rows) + "\n"
+        
+        print("Importing 4 rows...")
+        response = requests.post(
+            f"{BACKEND_URL}/patients/import",
+            data=body.encode("utf-8"),
+            headers={"Content-Type": "text/csv"}
+        )
+        self.assertEqual(response.status_code, 200, f"Failed to import patients: {response.text}")
+        result = response.json()
+        self.assertEqual(result["received"], 4)
+        self.assertEqual(result["imported"], 1)
+        self.assertEqual(result["duplicates"], 2)
+        self.assertEqual(result["invalid"], 1)
+        self.assertEqual({error["row"] for error in result["errors"]}, {2, 3, 4})
+        duplicates = {error["row"]: error["duplicate_of"] for error in result["errors"] if error["duplicate_of"]}
+        self.assertEqual(set(duplicates), {2, 3}, "Expected rows 2 and 3 to be reported as duplicates")
+        
+        response = requests.get(f"{BACKEND_URL}/search/patients", params={"q": f"Importado {suffix}"})
+        imported = response.json()
+        self.assertEqual(len(imported), 1, "Expected exactly one imported patient")
+        self.created_resources["patients"].append(imported[0]["id"])
+        self.assertEqual(imported[0]["cep"], "01001-000")
+        self.assertEqual(imported[0]["contact"], "(11) 98765-4321")
+        
+        print("Importing a file that turns out not to be UTF-8...")
+        row = [f"Parcial {suffix}", "Rua E, 5", "Centro", "São Paulo", "SP", "01001-000", "1990-07-01", "Feminino", "", ""]
+        body = "\n".join(",".join(f'"{value}"' for value in line) for line in [columns, row]) + "\n"
+        response = requests.post(
+            f"{BACKEND_URL}/patients/import",
+            data=body.encode("utf-8") + b'"\xff\xfe"\n',
+            headers={"Content-Type": "text/csv"}
+        )
+        self.assertEqual(response.status_code, 200, f"Failed to import patients: {response.text}")
+        result = response.json()
+        self.assertIn("UTF-8", result["error"])
+        self.assertEqual(result["imported"], 1, "Rows before the error should be kept")
+        response = requests.get(f"{BACKEND_URL}/search/patients", params={"q": f"Parcial {suffix}"})
+        self.assertEqual(len(response.json()), 1)
+        self.created_resources["patients"].append(response.json()[0]["id"])
+        
+        print("Bulk patient import successful")
+
+    def test_21_search_ranks_exact_match_among_many_prefixes(self):
+        """Test that an exact name match is found even when over 100 patients share its prefix"""
+        print("\n=== Testing Search Ranking With Many Prefix Matches ===")
+        
+        base = f"zq{uuid.uuid4().hex[:8]}"
+        rows = [dict(self.test_patient, name=f"{base}{i:03d} Prefixo") for i in range(120)]
+        rows.append(dict(self.test_patient, name=f"{base} Exato"))
+        body = "\n".join(json.dumps(row) for row in rows) + "\n"
+        
+        print("Importing 121 patients sharing a prefix...")
+        response = requests.post(
+            f"{BACKEND_URL}/patients/import",
+            data=body.encode("utf-8"),
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        self.assertEqual(response.status_code, 200, f"Failed to import patients: {response.text}")
+        self.assertEqual(response.json()["imported"], 121)
+        for q in (f"{base}0", f"{base}1", f"{base} exato"):
+            response = requests.get(f"{BACKEND_URL}/search/patients", params={"q": q, "limit": 100})
+            self.created_resources["patients"].extend(patient["id"] for patient in response.json())
+        self.assertEqual(len(set(self.created_resources["patients"])), 121)
+        
+        response = requests.get(f"{BACKEND_URL}/search/patients", params={"q": base, "limit": 5})
+        self.assertEqual(response.status_code, 200, f"Search failed: {response.text}")
+        results = response.json()
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0]["name"], f"{base} Exato", "Exact match should rank first")
+        
+        print("Search ranking with many prefix matches successful")
+
+    def test_22_recurring_appointment_series(self):
+        """Test booking a count-based weekly series and rejecting an until before the first date"""
+        print("\n=== Testing Recurring Appointment Series ===")
+        
+        response = requests.post(f"{BACKEND_URL}/patients", json=self.test_patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        series = {
+            "patient_id": patient_id,
+            "patient_name": "Maria Silva",
+            "date": "2031-05-05",
+            "time": "07:00",
+            "recurrence": {"interval": 1, "unit": "weeks", "count": 3}
+        }
+        print("Booking a weekly series of 3...")
+        response = requests.post(f"{BACKEND_URL}/appointments/series", json=series)
+        self.assertEqual(response.status_code, 200, f"Failed to create series: {response.text}")
+        appointments = response.json()["appointments"]
+        self.created_resources["appointments"].extend(appointment["id"] for appointment in appointments)
+        self.assertEqual([appointment["date"] for appointment in appointments], ["2031-05-05", "2031-05-12", "2031-05-19"])
+        self.assertEqual({appointment["series_id"] for appointment in appointments}, {response.json()["series_id"]})
+        
+        print("Booking a series whose until is before its first date...")
+        series["date"] = "2031-06-02"
+        series["recurrence"] = {"interval": 1, "unit": "weeks", "until": "2031-06-01"}
+        response = requests.post(f"{BACKEND_URL}/appointments/series", json=series)
+        self.assertEqual(response.status_code, 400, f"Expected 400 for an empty series, got: {response.status_code}")
+        self.assertIn("until is before the first occurrence", response.json()["detail"])
+        
+        print("Recurring appointment series successful")
+
+    def test_23_export_ndjson_and_csv(self):
+        """Test exporting patients and anamnesis as NDJSON and flattened, formula-safe CSV"""
+        print("\n=== Testing Export ===")
+        
+        patient = dict(self.test_patient, profession="=HYPERLINK(\"http://example.com\")")
+        response = requests.post(f"{BACKEND_URL}/patients", json=patient)
+        self.assertEqual(response.status_code, 200, f"Failed to create patient: {response.text}")
+        patient_id = response.json()["id"]
+        self.created_resources["patients"].append(patient_id)
+        
+        self.test_anamnesis["patient_id"] = patient_id
+        response = requests.post(f"{BACKEND_URL}/anamnesis", json=self.test_anamnesis)
+        self.assertEqual(response.status_code, 200, f"Failed to create anamnesis: {response.text}")
+        anamnesis_id = response.json()["id"]
+        self.created_resources["anamnesis"].append(anamnesis_id)
+        
+        print("Exporting patients as NDJSON...")
+        response = requests.get(f"{BACKEND_URL}/export/patients", params={"format": "ndjson"})
+        self.assertEqual(response.status_code, 200, f"Failed to export patients: {response.text}")
+        exported = {row["id"]: row for row in map(json.loads, response.text.splitlines())}
+        self.assertEqual(exported[patient_id]["name"], patient["name"])
+        self.assertFalse([key for key in exported[patient_id] if key.startswith("search_")], "Search keys leaked")
+        
+        print("Exporting anamnesis as NDJSON...")
+        response = requests.get(f"{BACKEND_URL}/export/anamnesis", params={"format": "ndjson"})
+        self.assertEqual(response.status_code, 200, f"Failed to export anamnesis: {response.text}")
+        exported = {row["id"]: row for row in map(json.loads, response.text.splitlines())}
+        term = exported[anamnesis_id]["responsibility_term"]
+        self.assertNotIn("signature", term, "Inline signature leaked")
+        self.assertTrue(term["signature_id"])
+        
+        print("Exporting anamnesis as CSV...")
+        response = requests.get(f"{BACKEND_URL}/export/anamnesis", params={"format": "csv"})
+        self.assertEqual(response.status_code, 200, f"Failed to export anamnesis: {response.text}")
+        rows = {row["id"]: row for row in csv.DictReader(io.StringIO(response.text))}
+        row = rows[anamnesis_id]
+        self.assertEqual(row["general_data.chief_complaint"], "Dor no calcanhar")
+        self.assertEqual(row["clinical_data.diabetes"], "true")
+        self.assertIn("responsibility_term.signature_id", row)
+        self.assertNotIn("responsibility_term.signature", row, "Inline signature column leaked")
+        
+        print("Exporting patients as CSV...")
+        response = requests.get(f"{BACKEND_URL}/export/patients", params={"format": "csv"})
+        self.assertEqual(response.status_code, 200, f"Failed to export patients: {response.text}")
+        rows = {row["id"]: row for row in csv.DictReader(io.StringIO(response.text))}
+        self.assertFalse([column for column in rows[patient_id] if column.startswith("search_")], "Search keys leaked")
+        self.assertEqual(rows[patient_id]["profession"], "'" + patient["profession"], "Formula was not escaped")
+        
+        print("Export successful")
+
+
+class NotificationQueryPlanTest(unittest.TestCase):
+    """explain() regression tests for the notification queue, run directly against MONGO_URL"""
+    
+    @classmethod
+    def setUpClass(cls):
+        sys.path.insert(0, str(Path(__file__).parent / "backend"))
+        import pymongo
+        import server
+        
+        cls.server = server
+        cls.client = pymongo.MongoClient(os.environ["MONGO_URL"])
+        cls.db = cls.client[f"{os.environ['DB_NAME']}_query_plans"]
+        cls.db.notifications.drop()
+        cls.db.notifications.create_indexes(server.INDEXES["notifications"])
+        
+        # Mostly sent notifications, as in a long-running clinic
+        now = datetime.utcnow()
+        cls.db.notifications.insert_many([
+            {"id": f"{i:05d}", "sent": i % 20 != 0, "scheduled_time": now + timedelta(minutes=i - 2500)}
+            for i in range(5000)
+        ])
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.drop_database(cls.db.name)
+        cls.client.close()
+    
+    def winning_stages(self, query):
+        explain = self.db.notifications.find(query) \
+            .sort([("scheduled_time", 1), ("id", 1)]) \
+            .limit(101) \
+            .explain()
+        
+        stages = []
+        def collect(node):
+            if isinstance(node, dict):
+                if "stage" in node:
+                    stages.append(node["stage"])
+                for value in node.values():
+                    collect(value)
+            elif isinstance(node, list):
+                for value in node:
+                    collect(value)
+        collect(explain["queryPlanner"]["winningPlan"])
+        return stages
+    
+    def assert_index_scan(self, query, allow_sort=False):
+        stages = self.winning_stages(query)
+        self.assertIn("IXSCAN", stages, f"Expected an index scan, got plan stages {stages}")
+        self.assertNotIn("COLLSCAN", stages, f"Unexpected collection scan in plan stages {stages}")
+        if not allow_sort:
+            self.assertNotIn("SORT", stages, f"Unexpected in-memory sort in plan stages {stages}")
+    
+    def test_pending_notifications_plan(self):
+        now = datetime.utcnow()
+        self.assert_index_scan(self.server.unsent_notifications_query(None, now))
+    
+    def test_upcoming_notifications_plan(self):
+        now = datetime.utcnow()
+        self.assert_index_scan(self.server.unsent_notifications_query(now, now + timedelta(hours=24)))
+    
+    def test_pending_notifications_next_page_plan(self):
+        now = datetime.utcnow()
+        cursor = self.server.encode_cursor(now - timedelta(hours=10), "00100")
+        query = {**self.server.unsent_notifications_query(None, now), **self.server.keyset_filter(cursor, "scheduled_time")}
+        # The keyset $or may be planned as a merge of two index scans
+        self.assert_index_scan(query, allow_sort=True)
+
+
+class NotificationDispatcherTest(unittest.IsolatedAsyncioTestCase):
+    """Dispatcher claim/send/retry cycle with FakeSender, run directly against MONGO_URL"""
+    
+    async def asyncSetUp(self):
+        sys.path.insert(0, str(Path(__file__).parent / "backend"))
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from notification_dispatcher import FakeSender, NotificationDispatcher
+        
+        self.client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+        self.db = self.client[f"{os.environ['DB_NAME']}_dispatcher"]
+        await self.db.notifications.drop()
+        self.sender = FakeSender()
+        self.dispatcher = NotificationDispatcher(self.db, self.sender, max_attempts=2)
+    
+    async def asyncTearDown(self):
+        await self.client.drop_database(self.db.name)
+        self.client.close()
+    
+    def notification(self, notification_id, scheduled_time):
+        return {
+            "id": notification_id,
+            "appointment_id": "appointment",
+            "patient_id": "patient",
+            "patient_name": "Maria Silva",
+            "patient_contact": "11987654321",
+            "notification_type": "1_hour_30_before",
+            "scheduled_time": scheduled_time,
+            "appointment_date": "2031-04-07",
+            "appointment_time": "09:00",
+            "template_version": 1,
+            "sent": False
+        }
+    
+    async def test_sends_due_notifications_once(self):
+        now = datetime.utcnow()
+        await self.db.notifications.insert_many([
+            self.notification("due", now - timedelta(minutes=5)),
+            self.notification("future", now + timedelta(hours=1)),
+            # Its appointment is long over; sending it now would only confuse the patient
+            self.notification("stale", now - timedelta(days=3))
+        ])
+        
+        self.assertEqual(await self.dispatcher.run_once(), 1)
+        self.assertEqual([notification["id"] for notification in self.sender.sent], ["due"])
+        self.assertTrue(self.sender.sent[0]["message"], "Expected a rendered message")
+        
+        sent = await self.db.notifications.find_one({"id": "due"})
+        self.assertTrue(sent["sent"])
+        self.assertIn("sent_at", sent)
+        self.assertNotIn("claimed_by", sent)
+        self.assertNotIn("lease_until", sent)
+        stale = await self.db.notifications.find_one({"id": "stale"})
+        self.assertFalse(stale["sent"])
+        
+        # Nothing is claimed twice
+        self.assertEqual(await self.dispatcher.run_once(), 0)
+        self.assertEqual(len(self.sender.sent), 1)
+    
+    async def test_leased_notification_is_not_claimed(self):
+        now = datetime.utcnow()
+        notification = self.notification("leased", now - timedelta(minutes=5))
+        notification.update({"claimed_by": "other-worker", "lease_until": now + timedelta(minutes=1)})
+        await self.db.notifications.insert_one(notification)
+        
+        self.assertEqual(await self.dispatcher.run_once(), 0)
+        self.assertEqual(self.sender.sent, [])
+    
+    async def test_failing_notification_is_parked(self):
+        async def fail(notification):
+            raise RuntimeError("gateway down")
+        self.sender.send = fail
+        await self.db.notifications.insert_one(self.notification("failing", datetime.utcnow() - timedelta(minutes=5)))
+        
+        self.assertEqual(await self.dispatcher.run_once(), 1)
+        retrying = await self.db.notifications.find_one({"id": "failing"})
+        self.assertEqual(retrying["attempts"], 1)
+        self.assertNotIn("failed", retrying)
+        self.assertEqual(await self.dispatcher.run_once(), 0, "Expected a retry delay before the next attempt")
+        
+        await self.db.notifications.update_one({"id": "failing"}, {"$set": {"lease_until": datetime.utcnow() - timedelta(seconds=1)}})
+        self.assertEqual(await self.dispatcher.run_once(), 1)
+        parked = await self.db.notifications.find_one({"id": "failing"})
+        self.assertEqual(parked["attempts"], 2)
+        self.assertTrue(parked["failed"])
+        self.assertFalse(parked["sent"])
+        self.assertEqual(await self.dispatcher.run_once(), 0, "A parked notification must not be retried")
+
+
+class NotificationBrokerTest(unittest.IsolatedAsyncioTestCase):
+    """Stream broker fan-out across workers, run directly against MONGO_URL"""
+    
+    async def asyncSetUp(self):
+        sys.path.insert(0, str(Path(__file__).parent / "backend"))
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from notification_stream import NotificationBroker
+        
+        self.client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+        self.db = self.client[f"{os.environ['DB_NAME']}_broker"]
+        await self.db.notifications.drop()
+        # Two workers sharing one database; neither runs its background task here
+        self.brokers = [NotificationBroker(self.db) for _ in range(2)]
+        start = datetime.utcnow() - timedelta(seconds=1)
+        for broker in self.brokers:
+            broker._created_since = start
+            broker._last_key = (start, "")
+        self.queues = [broker.subscribe() for broker in self.brokers]
+    
+    async def asyncTearDown(self):
+        await self.client.drop_database(self.db.name)
+        self.client.close()
+    
+    def received(self, queue):
+        ids = []
+        while not queue.empty():
+            ids.append(queue.get_nowait()["id"])
+        return ids
+    
+    async def test_booking_behind_the_scan_reaches_every_worker(self):
+        for broker in self.brokers:
+            await broker.publish_due()
+        
+        # Booked already due, e.g. the 1h30 reminder of an appointment an hour away
+        now = datetime.utcnow()
+        await self.db.notifications.insert_many([
+            {"id": "late", "sent": False, "scheduled_time": now - timedelta(minutes=30), "created_at": now},
+            {"id": "later", "sent": False, "scheduled_time": now + timedelta(hours=1), "created_at": now}
+        ])
+        self.brokers[0].booked([])
+        
+        for broker in self.brokers:
+            await broker.publish_due()
+        self.assertEqual([self.received(queue) for queue in self.queues], [["late"], ["late"]])
+        
+        # Overlapping created_at windows must not announce it again
+        for broker in self.brokers:
+            await broker.publish_due()
+        self.assertEqual([self.received(queue) for queue in self.queues], [[], []])
+
+
+class NotificationArchiverTest(unittest.IsolatedAsyncioTestCase):
+    """Archiver moves into notifications_archive, run directly against MONGO_URL"""
+    
+    async def asyncSetUp(self):
+        sys.path.insert(0, str(Path(__file__).parent / "backend"))
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from notification_archive import NotificationArchiver
+        
+        self.client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+        self.db = self.client[f"{os.environ['DB_NAME']}_archive"]
+        await self.db.notifications.drop()
+        await self.db.notifications_archive.drop()
+        self.archiver = NotificationArchiver(self.db, batch_size=2)
+    
+    async def asyncTearDown(self):
+        await self.client.drop_database(self.db.name)
+        self.client.close()
+    
+    async def insert(self, notification_id, scheduled_time, sent):
+        await self.db.notifications.insert_one({
+            "id": notification_id,
+            "appointment_id": "appointment",
+            "scheduled_time": scheduled_time,
+            "sent": sent
+        })
+    
+    async def ids(self, collection):
+        return sorted(notification["id"] for notification in await collection.find({}, {"id": 1}).to_list(None))
+    
+    async def test_moves_sent_and_expired_notifications(self):
+        now = datetime.utcnow()
+        for index in range(3):
+            await self.insert(f"sent-{index}", now - timedelta(hours=2), True)
+        await self.insert("expired", now - timedelta(days=3), False)
+        await self.insert("pending", now + timedelta(hours=1), False)
+        # Past due but still inside the window the dispatcher may send it in
+        await self.insert("due", now - timedelta(hours=1), False)
+        
+        self.assertEqual(await self.archiver.run_once(), 4)
+        self.assertEqual(await self.ids(self.db.notifications), ["due", "pending"])
+        self.assertEqual(
+            await self.ids(self.db.notifications_archive),
+            ["expired", "sent-0", "sent-1", "sent-2"]
+        )
+        async for archived in self.db.notifications_archive.find():
+            self.assertIsInstance(archived["archived_at"], datetime)
+        
+        self.assertEqual(await self.archiver.run_once(), 0)
+    
+    async def test_rerun_after_partial_insert_is_idempotent(self):
+        now = datetime.utcnow()
+        await self.insert("copied", now - timedelta(hours=2), True)
+        await self.insert("missing", now - timedelta(hours=2), True)
+        # An earlier run copied one row and died before deleting anything
+        copied = await self.db.notifications.find_one({"id": "copied"})
+        await self.db.notifications_archive.insert_one({**copied, "archived_at": now - timedelta(minutes=5)})
+        
+        self.assertEqual(await self.archiver.run_once(), 2)
+        self.assertEqual(await self.ids(self.db.notifications), [])
+        self.assertEqual(await self.ids(self.db.notifications_archive), ["copied", "missing"])
+
+
 if __name__ == "__main__":
     # Run the tests
     unittest.main(argv=['first-arg-is-ignored'], exit=False)
\ No newline at end of file
@@ -6,6 +6,69 @@ import axios from "axios";
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+const PATIENTS_PAGE_SIZE = 50;
+
+// Patients a page at a time: the first page on load, later ones on demand through
+// the X-Next-Cursor header, and /search/patients while a search term is typed
+const usePatients = (searchTerm) => {
+  const [patients, setPatients] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loading, setLoading] = useState(false);
+  // Responses for an older search term are dropped
+  const requestRef = useRef(0);
+
+  const fetchPage = async (cursor) => {
+    const response = await axios.get(`${API}/patients`, {
+      params: { limit: PATIENTS_PAGE_SIZE, ...(cursor ? { cursor } : {}) },
+    });
+    return { page: response.data, cursor: response.headers["x-next-cursor"] || null };
+  };
+
+  useEffect(() => {
+    const request = ++requestRef.current;
+    const term = searchTerm.trim();
+    const timer = setTimeout(async () => {
+      setLoading(true);
+      try {
+        if (term) {
+          const response = await axios.get(`${API}/search/patients`, { params: { q: term, limit: 100 } });
+          if (request !== requestRef.current) return;
+          setPatients(response.data);
+          setNextCursor(null);
+        } else {
+          const { page, cursor } = await fetchPage(null);
+          if (request !== requestRef.current) return;
+          setPatients(page);
+          setNextCursor(cursor);
+        }
+      } catch (error) {
+        console.error("Erro ao carregar pacientes:", error);
+      } finally {
+        if (request === requestRef.current) setLoading(false);
+      }
+    }, term ? 300 : 0);
+    return () => clearTimeout(timer);
+  }, [searchTerm]);
+
+  const loadMore = async () => {
+    if (!nextCursor || loading) return;
+    const request = requestRef.current;
+    setLoading(true);
+    try {
+      const { page, cursor } = await fetchPage(nextCursor);
+      if (request !== requestRef.current) return;
+      setPatients(current => [...current, ...page]);
+      setNextCursor(cursor);
+    } catch (error) {
+      console.error("Erro ao carregar pacientes:", error);
+    } finally {
+      if (request === requestRef.current) setLoading(false);
+    }
+  };
+
+  return { patients, hasMore: Boolean(nextCursor), loading, loadMore };
+};
+
 // Signature Canvas Component
 const SignatureCanvas = ({ onSignatureChange }) => {
   const canvasRef = useRef(null);
@@ -924,31 +987,8 @@ const AnamnesisForm = () => {
 
 // Patients List Component
 const PatientsList = () => {
-  const [patients, setPatients] = useState([]);
   const [searchTerm, setSearchTerm] = useState("");
-  const [filteredPatients, setFilteredPatients] = useState([]);
-
-  useEffect(() => {
-    const fetchPatients = async () => {
-      try {
-        const response = await axios.get(`${API}/patients`);
-        setPatients(response.data);
-        setFilteredPatients(response.data);
-      } catch (error) {
-        console.error("Erro ao carregar pacientes:", error);
-      }
-    };
-
-    fetchPatients();
-  }, []);
-
-  useEffect(() => {
-    const filtered = patients.filter(patient => 
-      patient.name.toLowerCase().includes(searchTerm.toLowerCase()) ||
-      patient.contact.includes(searchTerm)
-    );
-    setFilteredPatients(filtered);
-  }, [searchTerm, patients]);
+  const { patients, hasMore, loading, loadMore } = usePatients(searchTerm);
 
   return (
     <div className="container">
@@ -969,7 +1009,7 @@ const PatientsList = () => {
       </div>
       
       <div className="patients-grid">
-        {filteredPatients.map(patient => (
+        {patients.map(patient => (
           <div key={patient.id} className="patient-card">
             <h3>{patient.name}</h3>
             <p><strong>Telefone:</strong> {patient.contact}</p>
@@ -986,6 +1026,14 @@ const PatientsList = () => {
           </div>
         ))}
       </div>
+
+      {hasMore && (
+        <div className="load-more">
+          <button type="button" className="btn btn-secondary" onClick={loadMore} disabled={loading}>
+            {loading ? "Carregando..." : "Carregar mais pacientes"}
+          </button>
+        </div>
+      )}
     </div>
   );
 };
@@ -998,9 +1046,17 @@ const Notifications = () => {
 
   useEffect(() => {
     fetchNotifications();
-    // Refresh every 5 minutes
-    const interval = setInterval(fetchNotifications, 5 * 60 * 1000);
-    return () => clearInterval(interval);
+    // The server pushes each notification when it becomes due; EventSource
+    // reconnects on its own and resumes from the last event it received
+    const stream = new EventSource(`${API}/notifications/stream`);
+    stream.addEventListener("notification", (event) => {
+      const notification = JSON.parse(event.data);
+      setPendingNotifications((pending) =>
+        pending.some((n) => n.id === notification.id) ? pending : [...pending, notification]
+      );
+      setUpcomingNotifications((upcoming) => upcoming.filter((n) => n.id !== notification.id));
+    });
+    return () => stream.close();
   }, []);
 
   const fetchNotifications = async () => {
@@ -1200,8 +1256,9 @@ const Notifications = () => {
 };
 const Appointments = () => {
   const [appointments, setAppointments] = useState([]);
-  const [patients, setPatients] = useState([]);
-  const [selectedPatient, setSelectedPatient] = useState("");
+  const [patientSearch, setPatientSearch] = useState("");
+  const { patients, hasMore, loading, loadMore } = usePatients(patientSearch);
+  const [selectedPatient, setSelectedPatient] = useState(null);
   const [selectedDate, setSelectedDate] = useState("");
   const [selectedTime, setSelectedTime] = useState("");
   const [currentDate, setCurrentDate] = useState(new Date());
@@ -1209,7 +1266,6 @@ const Appointments = () => {
 
   useEffect(() => {
     fetchAppointments();
-    fetchPatients();
   }, []);
 
   const fetchAppointments = async () => {
@@ -1221,22 +1277,17 @@ const Appointments = () => {
     }
   };
 
-  const fetchPatients = async () => {
-    try {
-      const response = await axios.get(`${API}/patients`);
-      setPatients(response.data);
-    } catch (error) {
-      console.error("Erro ao carregar pacientes:", error);
-    }
-  };
+  // Keep the chosen patient selectable after the search moves on
+  const patientOptions = selectedPatient && !patients.some(p => p.id === selectedPatient.id)
+    ? [selectedPatient, ...patients]
+    : patients;
 
   const handleCreateAppointment = async (e) => {
     e.preventDefault();
     try {
-      const patient = patients.find(p => p.id === selectedPatient);
       const appointmentData = {
-        patient_id: selectedPatient,
-        patient_name: patient.name,
+        patient_id: selectedPatient.id,
+        patient_name: selectedPatient.name,
         date: selectedDate,
         time: selectedTime
       };
@@ -1244,7 +1295,8 @@ const Appointments = () => {
       await axios.post(`${API}/appointments`, appointmentData);
       alert("Agendamento criado com sucesso!");
       setShowForm(false);
-      setSelectedPatient("");
+      setSelectedPatient(null);
+      setPatientSearch("");
       setSelectedDate("");
       setSelectedTime("");
       fetchAppointments();
@@ -1322,18 +1374,29 @@ const Appointments = () => {
           <form onSubmit={handleCreateAppointment}>
             <div className="form-group">
               <label>Paciente *</label>
+              <input
+                type="text"
+                placeholder="Buscar por nome ou telefone..."
+                value={patientSearch}
+                onChange={(e) => setPatientSearch(e.target.value)}
+              />
               <select
-                value={selectedPatient}
-                onChange={(e) => setSelectedPatient(e.target.value)}
+                value={selectedPatient ? selectedPatient.id : ""}
+                onChange={(e) => setSelectedPatient(patientOptions.find(p => p.id === e.target.value) || null)}
                 required
               >
                 <option value="">Selecione um paciente</option>
-                {patients.map(patient => (
+                {patientOptions.map(patient => (
                   <option key={patient.id} value={patient.id}>
                     {patient.name} - {patient.contact}
                   </option>
                 ))}
               </select>
+              {hasMore && (
+                <button type="button" className="btn btn-secondary" onClick={loadMore} disabled={loading}>
+                  {loading ? "Carregando..." : "Carregar mais pacientes"}
+                </button>
+              )}
             </div>
             
             <div className="form-row">